@@ -0,0 +1,177 @@
+"""
+Endpoint benchmarks: seeds a synthetic dataset in a scratch database, drives the API
+through the Flask test client and records p50/p95 latency, SQL statement count and
+response size per endpoint. Run it from the repository root:
+
+    pipenv run python benchmarks/endpoints.py --orders 100000 --output bench.json
+    pipenv run python benchmarks/endpoints.py --compare bench.json
+
+BENCHMARK_DATABASE_URL selects the database (a SQLite file in /tmp by default); it is
+dropped and recreated on every run.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL', 'sqlite:////tmp/benchmark.db')
+os.environ.setdefault('JWT_SECRET_KEY', 'benchmark')
+os.environ.setdefault('MAIL_DEFAULT_SENDER', 'benchmark@example.org')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from werkzeug.security import generate_password_hash
+from main import app
+from models import db, User, Order, Role, ROLES, STATUSES
+from instrumentation import StatementCounter
+
+ADMIN_EMAIL = 'benchmark-admin@example.org'
+PASSWORD = 'benchmark'
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def prepare_dataset(users, orders, seed):
+    db.drop_all()
+    db.create_all()
+    ROLES.invalidate()
+    STATUSES.invalidate()
+    result = app.test_cli_runner().invoke(args=['seed-synthetic', '--users', str(users), '--orders', str(orders), '--seed', str(seed)])
+    if result.exception:
+        raise result.exception
+    admin = User(email=ADMIN_EMAIL, password=generate_password_hash(PASSWORD, method='sha256'), full_name='Benchmark', phone='600000000', role_id=Role.ADMIN_ROLE_ID, is_active=True)
+    admin.save()
+    # Busiest active helper, the worst case for the helper scoped listing
+    helper_id, = db.session.query(Order.helper_id).join(User, User.id == Order.helper_id).filter(User.is_active == True).group_by(Order.helper_id).order_by(db.func.count().desc()).first()
+    helper = User.query.get(helper_id)
+    helper.password = generate_password_hash(PASSWORD, method='sha256')
+    db.session.commit()
+    order_ids = [order_id for order_id, in db.session.query(Order.id).filter(Order.active == True)]
+    return helper.email, order_ids
+
+def run(args):
+    with app.app_context():
+        started = time.monotonic()
+        helper_email, order_ids = prepare_dataset(args.users, args.orders, args.seed)
+        print(f'Dataset ready in {time.monotonic() - started:.1f}s')
+        counter = StatementCounter(db.engine)
+        database = db.engine.dialect.name
+
+    client = app.test_client()
+    tokens = {}
+    for role, email in (('admin', ADMIN_EMAIL), ('helper', helper_email)):
+        tokens[role] = {'Authorization': 'Bearer ' + client.post('/login', json={'email': email, 'password': PASSWORD}).json['access_token']}
+
+    generator = random.Random(args.seed)
+    endpoints = {
+        'POST /login': lambda: client.post('/login', json={'email': ADMIN_EMAIL, 'password': PASSWORD}),
+        'GET /orders (admin, first page)': lambda: client.get('/orders', headers=tokens['admin']),
+        'GET /orders (admin, limit=50)': lambda: client.get('/orders?limit=50', headers=tokens['admin']),
+        'GET /orders (helper, first page)': lambda: client.get('/orders', headers=tokens['helper']),
+        'GET /orders/<id>': lambda: client.get(f'/orders/{generator.choice(order_ids)}', headers=tokens['admin']),
+        'GET /users': lambda: client.get('/users', headers=tokens['admin']),
+        'GET /helpers': lambda: client.get('/helpers', headers=tokens['admin']),
+        'POST /orders/<id>/accept': lambda: client.post(f'/orders/{generator.choice(order_ids)}/accept', headers=tokens['admin']),
+        'POST /orders/<id>/reject': lambda: client.post(f'/orders/{generator.choice(order_ids)}/reject', headers=tokens['admin']),
+        'POST /orders/<id>/set-ready': lambda: client.post(f'/orders/{generator.choice(order_ids)}/set-ready', headers=tokens['admin']),
+        'POST /orders/<id>/set-approved': lambda: client.post(f'/orders/{generator.choice(order_ids)}/set-approved', headers=tokens['admin']),
+    }
+
+    results = {}
+    with counter:
+        for name, request in endpoints.items():
+            if args.only and args.only not in name:
+                continue
+            # Warm up caches (lookup tables, user access) so they don't skew the numbers
+            request()
+            latencies, statements, sizes = [], [], []
+            for _ in range(args.requests):
+                counter.count = 0
+                started = time.perf_counter()
+                response = request()
+                latencies.append((time.perf_counter() - started) * 1000)
+                statements.append(counter.count)
+                sizes.append(len(response.get_data()))
+                if response.status_code >= 400:
+                    raise RuntimeError(f'{name} answered {response.status_code}: {response.get_data(as_text=True)[:200]}')
+            results[name] = {
+                "p50_ms": round(percentile(latencies, 50), 2),
+                "p95_ms": round(percentile(latencies, 95), 2),
+                "mean_ms": round(statistics.mean(latencies), 2),
+                "statements": round(statistics.mean(statements), 2),
+                "response_bytes": round(statistics.mean(sizes)),
+            }
+            print(f'{name:<36} p50 {results[name]["p50_ms"]:9.2f} ms  p95 {results[name]["p95_ms"]:9.2f} ms  '
+                  f'{results[name]["statements"]:6.1f} SQL  {results[name]["response_bytes"]:>10} B')
+
+    return {
+        "commit": git_commit(),
+        "created_at": datetime.datetime.utcnow().isoformat(),
+        "database": database,
+        "dataset": {"users": args.users, "orders": args.orders, "seed": args.seed},
+        "requests": args.requests,
+        "endpoints": results,
+    }
+
+def compare(baseline, current, threshold):
+    print(f'\nAgainst {baseline.get("commit")} ({baseline["dataset"]["orders"]} orders):')
+    regressions = 0
+    for name, result in current["endpoints"].items():
+        previous = baseline["endpoints"].get(name)
+        if previous is None:
+            continue
+        change = (result["p50_ms"] - previous["p50_ms"]) / previous["p50_ms"] * 100 if previous["p50_ms"] else 0
+        # Averages move a little with the randomly picked orders, a whole extra statement does not
+        more_statements = result["statements"] - previous["statements"] >= 1
+        flag = ''
+        if change > threshold or more_statements:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f'{name:<36} p50 {previous["p50_ms"]:9.2f} -> {result["p50_ms"]:9.2f} ms ({change:+6.1f}%)  '
+              f'SQL {previous["statements"]:.1f} -> {result["statements"]:.1f}{flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=50, help='Requests per endpoint')
+    parser.add_argument('--only', default=None, help='Run only the endpoints whose name contains this text')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='Results JSON of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=20, help='p50 increase, in percent, reported as a regression')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        # Same dataset as the baseline unless asked otherwise
+        for key in ('users', 'orders', 'seed'):
+            if parser.get_default(key) == getattr(args, key):
+                setattr(args, key, baseline["dataset"][key])
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f'Results written to {args.output}')
+    if baseline and compare(baseline, results, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
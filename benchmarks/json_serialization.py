@@ -0,0 +1,96 @@
+"""
+Micro-benchmark of the order list serialization: the previous hand-written dicts
+encoded by flask.jsonify against the generated column serializers encoded by each
+available JSON provider. Run it from the repository root:
+
+    pipenv run python benchmarks/json_serialization.py --orders 10000
+"""
+import os
+import sys
+import time
+import datetime
+import argparse
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCHMARK_DATABASE_URL', 'sqlite:////tmp/benchmark.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from flask import jsonify as flask_jsonify
+from main import app
+from models import db, User, Order, Role, Status, ROLES, STATUSES
+from jsonprovider import JSON_PROVIDERS, jsonify
+
+def legacy_serialize_order(order):
+    # Serialization as it was written by hand before the generated serializers
+    return {
+        "id": order.id,
+        "helper_id": order.helper_id,
+        "helper": {
+            "id": order.helper.id,
+            "email": order.helper.email,
+            "full_name": order.helper.full_name,
+            "phone": order.helper.phone,
+            "role_id": order.helper.role_id,
+            "role": ROLES.get(order.helper.role_id)
+        },
+        "status": STATUSES.get(order.status_id),
+        "status_id": order.status_id,
+        "description": order.description,
+        "long_description": order.long_description,
+        "created_at": order.created_at
+    }
+
+def build_orders(count):
+    created_at = datetime.datetime(2021, 1, 1)
+    helpers = [
+        User(id=i, email=f'helper{i}@ayudame3d.org', full_name=f'Helper {i}', phone='600000000', role_id=Role.HELPER_ROLE_ID)
+        for i in range(1, 51)
+    ]
+    return [
+        Order(
+            id=i,
+            description=f'Pantalla protectora {i}',
+            long_description='Impresión de viseras para el centro de salud ' * 5,
+            helper_id=helpers[i % len(helpers)].id,
+            helper=helpers[i % len(helpers)],
+            status_id=1 + i % 6,
+            created_at=created_at + datetime.timedelta(minutes=i)
+        )
+        for i in range(count)
+    ]
+
+def measure(name, function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = len(function().get_data())
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    print(f'{name:<40} best {best * 1000:8.1f} ms   {size} bytes')
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.create_all()
+        for id, name in ((Role.HELPER_ROLE_ID, 'Helper'),):
+            db.session.merge(Role(id=id, name=name))
+        for id in range(1, 7):
+            db.session.merge(Status(id=id, name=f'Status {id}'))
+        db.session.commit()
+        ROLES.invalidate()
+        STATUSES.invalidate()
+
+        orders = build_orders(args.orders)
+        print(f'{args.orders} orders, best of {args.repeat}')
+        baseline = measure('hand-written dicts + flask.jsonify', lambda: flask_jsonify([legacy_serialize_order(order) for order in orders]), args.repeat)
+        for name in JSON_PROVIDERS:
+            app.extensions['json_provider'] = JSON_PROVIDERS[name]()
+            best = measure(f'generated serializers + {name}', lambda: jsonify([order.serialize() for order in orders]), args.repeat)
+            print(f'{"":<40} x{baseline / best:.2f}')
+
+if __name__ == '__main__':
+    main()
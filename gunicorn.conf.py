@@ -0,0 +1,19 @@
+"""
+Gunicorn settings of the web process, see Procfile. With PROMETHEUS_MULTIPROC_DIR set
+the metrics files of the previous run are removed on start, and the workers that exit
+are marked dead so /metrics stops adding up their gauges
+"""
+import os
+import glob
+from prometheus_client import multiprocess
+
+def on_starting(server):
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
@@ -27,6 +27,18 @@ config.set_main_option(
     str(current_app.extensions['migrate'].db.engine.url).replace('%', '%%'))
 target_metadata = current_app.extensions['migrate'].db.metadata
 
+# Full text search lives outside the models, see ORDER_SEARCH_DDL in models.py:
+# autogenerate must not drop it
+def include_object(object, name, type_, reflected, compare_to):
+    if type_ == 'column' and name == 'search_vector' and object.table.name == 'order':
+        return False
+    if type_ == 'index' and name == 'ix_order_search_vector':
+        return False
+    # The FTS5 table and its shadow tables (order_search_data, order_search_idx...)
+    if type_ == 'table' and (name == 'order_search' or name.startswith('order_search_')):
+        return False
+    return True
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -47,7 +59,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object
     )
 
     with context.begin_transaction():
@@ -83,6 +96,7 @@ def run_migrations_online():
             connection=connection,
             target_metadata=target_metadata,
             process_revision_directives=process_revision_directives,
+            include_object=include_object,
             **current_app.extensions['migrate'].configure_args
         )
 
@@ -0,0 +1,34 @@
+"""add order changes
+
+Revision ID: 00177959a76e
+Revises: 282778032115
+Create Date: 2026-10-18 17:20:13.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '00177959a76e'
+down_revision = '282778032115'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('order_change',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('helper_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_order_change_helper_id_id', 'order_change', ['helper_id', 'id'], unique=False)
+    op.create_index('ix_order_change_order_id_helper_id_id', 'order_change', ['order_id', 'helper_id', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_order_change_order_id_helper_id_id', table_name='order_change')
+    op.drop_index('ix_order_change_helper_id_id', table_name='order_change')
+    op.drop_table('order_change')
@@ -0,0 +1,48 @@
+"""add order full text search
+
+Revision ID: 215a1659dc11
+Revises: 81836ac549e8
+Create Date: 2026-10-18 18:47:30.118562
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '215a1659dc11'
+down_revision = '81836ac549e8'
+branch_labels = None
+depends_on = None
+
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('spanish', coalesce(description, '')), 'A') || "
+    "setweight(to_tsvector('spanish', coalesce(long_description, '')), 'B')"
+)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute(f'ALTER TABLE "order" ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR}) STORED')
+        op.execute('CREATE INDEX ix_order_search_vector ON "order" USING gin (search_vector)')
+    elif dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE order_search USING fts5(description, long_description, content='order', content_rowid='id', tokenize='unicode61 remove_diacritics 2')")
+        op.execute('CREATE TRIGGER order_search_insert AFTER INSERT ON "order" BEGIN '
+                   'INSERT INTO order_search (rowid, description, long_description) VALUES (new.id, new.description, new.long_description); END')
+        op.execute('CREATE TRIGGER order_search_delete AFTER DELETE ON "order" BEGIN '
+                   "INSERT INTO order_search (order_search, rowid, description, long_description) VALUES ('delete', old.id, old.description, old.long_description); END")
+        op.execute('CREATE TRIGGER order_search_update AFTER UPDATE OF description, long_description ON "order" BEGIN '
+                   "INSERT INTO order_search (order_search, rowid, description, long_description) VALUES ('delete', old.id, old.description, old.long_description); "
+                   'INSERT INTO order_search (rowid, description, long_description) VALUES (new.id, new.description, new.long_description); END')
+        op.execute("INSERT INTO order_search (order_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.drop_index('ix_order_search_vector', table_name='order')
+        op.drop_column('order', 'search_vector')
+    elif dialect == 'sqlite':
+        for trigger in ('order_search_insert', 'order_search_delete', 'order_search_update'):
+            op.execute(f'DROP TRIGGER {trigger}')
+        op.execute('DROP TABLE order_search')
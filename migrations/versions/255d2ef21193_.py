@@ -0,0 +1,30 @@
+"""add document content hash and size
+
+Revision ID: 255d2ef21193
+Revises: b9cf1fe3e9fd
+Create Date: 2026-10-18 20:12:44.905127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '255d2ef21193'
+down_revision = 'b9cf1fe3e9fd'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('document', sa.Column('sha256', sa.String(length=64), nullable=True))
+    op.add_column('document', sa.Column('size', sa.BigInteger(), nullable=True))
+    op.add_column('archived_document', sa.Column('sha256', sa.String(length=64), nullable=True))
+    op.add_column('archived_document', sa.Column('size', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('archived_document', 'size')
+    op.drop_column('archived_document', 'sha256')
+    op.drop_column('document', 'size')
+    op.drop_column('document', 'sha256')
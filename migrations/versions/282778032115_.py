@@ -0,0 +1,29 @@
+"""add user writes
+
+Revision ID: 282778032115
+Revises: 9d5fd247170f
+Create Date: 2026-10-18 16:02:41.518203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '282778032115'
+down_revision = '9d5fd247170f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_write',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('written_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('user_write')
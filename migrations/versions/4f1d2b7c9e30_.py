@@ -0,0 +1,33 @@
+"""order changes in commit order
+
+Revision ID: 4f1d2b7c9e30
+Revises: 83c740c956b8
+Create Date: 2026-10-18 18:52:13.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4f1d2b7c9e30'
+down_revision = '83c740c956b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows get txid 0, below every new one, so the feed keeps their id order
+    op.add_column('order_change', sa.Column('txid', sa.BigInteger(), server_default='0', nullable=False))
+    op.drop_index('ix_order_change_helper_id_id', table_name='order_change')
+    op.drop_index('ix_order_change_order_id_helper_id_id', table_name='order_change')
+    op.create_index('ix_order_change_helper_id_txid_id', 'order_change', ['helper_id', 'txid', 'id'], unique=False)
+    op.create_index('ix_order_change_order_id_helper_id_txid_id', 'order_change', ['order_id', 'helper_id', 'txid', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_order_change_order_id_helper_id_txid_id', table_name='order_change')
+    op.drop_index('ix_order_change_helper_id_txid_id', table_name='order_change')
+    op.create_index('ix_order_change_order_id_helper_id_id', 'order_change', ['order_id', 'helper_id', 'id'], unique=False)
+    op.create_index('ix_order_change_helper_id_id', 'order_change', ['helper_id', 'id'], unique=False)
+    op.drop_column('order_change', 'txid')
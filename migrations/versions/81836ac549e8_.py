@@ -0,0 +1,44 @@
+"""add order stats
+
+Revision ID: 81836ac549e8
+Revises: 00177959a76e
+Create Date: 2026-10-18 18:04:52.671330
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '81836ac549e8'
+down_revision = '00177959a76e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('order', sa.Column('status_changed_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True))
+    # Existing orders: the time of the last status change is unknown, count from creation
+    op.execute('UPDATE "order" SET status_changed_at = created_at')
+    op.create_table('order_stat',
+    sa.Column('status_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('helper_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('orders', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('status_id', 'helper_id')
+    )
+    op.create_table('order_status_time',
+    sa.Column('status_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('total_seconds', sa.Float(), nullable=False),
+    sa.Column('transitions', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('status_id')
+    )
+    op.execute(
+        'INSERT INTO order_stat (status_id, helper_id, orders) '
+        'SELECT status_id, helper_id, count(*) FROM "order" WHERE active GROUP BY status_id, helper_id'
+    )
+
+
+def downgrade():
+    op.drop_table('order_status_time')
+    op.drop_table('order_stat')
+    op.drop_column('order', 'status_changed_at')
@@ -0,0 +1,29 @@
+"""drop user writes, the session cookie keeps the last write
+
+Revision ID: 83c740c956b8
+Revises: 255d2ef21193
+Create Date: 2026-10-18 18:20:07.311954
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '83c740c956b8'
+down_revision = '255d2ef21193'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.drop_table('user_write')
+
+
+def downgrade():
+    op.create_table('user_write',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('written_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id')
+    )
@@ -0,0 +1,38 @@
+"""add email outbox
+
+Revision ID: 8aa33637baad
+Revises: c03961b70db2
+Create Date: 2026-10-18 11:02:17.583921
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8aa33637baad'
+down_revision = 'c03961b70db2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox_email',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('to_email', sa.String(length=120), nullable=False),
+    sa.Column('subject', sa.String(length=250), nullable=False),
+    sa.Column('html_content', sa.Text(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('last_error', sa.String(length=500), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.Column('next_attempt_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_outbox_email_pending_next_attempt_at', 'outbox_email', ['next_attempt_at'], unique=False, postgresql_where=sa.text("status = 'pending'"), sqlite_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_outbox_email_pending_next_attempt_at', table_name='outbox_email')
+    op.drop_table('outbox_email')
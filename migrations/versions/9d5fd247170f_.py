@@ -0,0 +1,32 @@
+"""add table versions
+
+Revision ID: 9d5fd247170f
+Revises: 8aa33637baad
+Create Date: 2026-10-18 12:21:05.348710
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d5fd247170f'
+down_revision = '8aa33637baad'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table('table_version',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [
+        {'name': name, 'version': 1}
+        for name in ('user', 'order', 'document', 'address', 'role', 'status')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
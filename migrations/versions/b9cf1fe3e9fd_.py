@@ -0,0 +1,58 @@
+"""add order archive
+
+Revision ID: b9cf1fe3e9fd
+Revises: 215a1659dc11
+Create Date: 2026-10-18 19:35:08.440719
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b9cf1fe3e9fd'
+down_revision = '215a1659dc11'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('archived_order',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('description', sa.String(length=120), nullable=False),
+    sa.Column('long_description', sa.String(length=5000), nullable=True),
+    sa.Column('active', sa.Boolean(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('status_changed_at', sa.DateTime(), nullable=True),
+    sa.Column('archived_at', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.Column('helper_id', sa.Integer(), nullable=False),
+    sa.Column('status_id', sa.Integer(), nullable=False),
+    sa.Column('address_delivery_id', sa.Integer(), nullable=True),
+    sa.Column('address_pickup_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['address_delivery_id'], ['address.id'], ),
+    sa.ForeignKeyConstraint(['address_pickup_id'], ['address.id'], ),
+    sa.ForeignKeyConstraint(['helper_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['status_id'], ['status.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_archived_order_helper_id_id', 'archived_order', ['helper_id', 'id'], unique=False)
+    op.create_table('archived_document',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('name', sa.String(length=250), nullable=False),
+    sa.Column('url', sa.String(length=255), nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['order_id'], ['archived_order.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_archived_document_order_id'), 'archived_document', ['order_id'], unique=False)
+    op.create_index('ix_order_cold_status_changed_at', 'order', ['status_changed_at'], unique=False, postgresql_where=sa.text('active = false OR status_id = 6'), sqlite_where=sa.text('active = 0 OR status_id = 6'))
+
+
+def downgrade():
+    op.drop_index('ix_order_cold_status_changed_at', table_name='order')
+    op.drop_index(op.f('ix_archived_document_order_id'), table_name='archived_document')
+    op.drop_table('archived_document')
+    op.drop_index('ix_archived_order_helper_id_id', table_name='archived_order')
+    op.drop_table('archived_order')
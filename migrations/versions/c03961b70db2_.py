@@ -0,0 +1,36 @@
+"""add listing indexes
+
+Revision ID: c03961b70db2
+Revises: 5101b292090f
+Create Date: 2026-10-18 10:12:41.208113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c03961b70db2'
+down_revision = '5101b292090f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_order_active_created_at_id', 'order', ['created_at', 'id'], unique=False, postgresql_where=sa.text('active = true'), sqlite_where=sa.text('active = 1'))
+    op.create_index('ix_order_active_helper_id_created_at_id', 'order', ['helper_id', 'created_at', 'id'], unique=False, postgresql_where=sa.text('active = true'), sqlite_where=sa.text('active = 1'))
+    op.create_index('ix_order_active_status_id_created_at_id', 'order', ['status_id', 'created_at', 'id'], unique=False, postgresql_where=sa.text('active = true'), sqlite_where=sa.text('active = 1'))
+    op.create_index('ix_user_role_id_id', 'user', ['role_id', 'id'], unique=False)
+    op.create_index('ix_user_active_id', 'user', ['id'], unique=False, postgresql_where=sa.text('is_active = true'), sqlite_where=sa.text('is_active = 1'))
+    op.create_index('ix_user_reset_password_token', 'user', ['reset_password_token'], unique=False, postgresql_where=sa.text('reset_password_token IS NOT NULL'), sqlite_where=sa.text('reset_password_token IS NOT NULL'))
+    op.create_index(op.f('ix_document_order_id'), 'document', ['order_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_document_order_id'), table_name='document')
+    op.drop_index('ix_user_reset_password_token', table_name='user')
+    op.drop_index('ix_user_active_id', table_name='user')
+    op.drop_index('ix_user_role_id_id', table_name='user')
+    op.drop_index('ix_order_active_status_id_created_at_id', table_name='order')
+    op.drop_index('ix_order_active_helper_id_created_at_id', table_name='order')
+    op.drop_index('ix_order_active_created_at_id', table_name='order')
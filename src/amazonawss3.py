@@ -1,25 +1,186 @@
-import os, boto3, botocore
+import os, time, uuid, hashlib, threading, boto3, botocore
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import secure_filename
+from instrumentation import timed
+from metrics import S3_UPLOAD_BYTES, S3_UPLOAD_DURATION, S3_UPLOAD_DEDUPLICATED
+
+MB = 1024 * 1024
+
+# AWS_S3_ENDPOINT_URL points the client to an S3 compatible server (MinIO, moto) for local runs
+AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL')
+AWS_S3_PART_SIZE_MB = int(os.environ.get('AWS_S3_PART_SIZE_MB', 16))
+AWS_S3_PART_CONCURRENCY = int(os.environ.get('AWS_S3_PART_CONCURRENCY', 8))
+AWS_S3_FILE_CONCURRENCY = int(os.environ.get('AWS_S3_FILE_CONCURRENCY', 4))
+AWS_S3_MAX_UPLOAD_MB = int(os.environ.get('AWS_S3_MAX_UPLOAD_MB', 2048))
+AWS_S3_UPLOAD_URL_EXPIRATION = int(os.environ.get('AWS_S3_UPLOAD_URL_EXPIRATION', 3600))
+AWS_S3_ALLOWED_CONTENT_TYPES = os.environ.get('AWS_S3_ALLOWED_CONTENT_TYPES', 'video/,image/,application/pdf').split(',')
+# Files uploaded through the API are stored once per content under this prefix
+AWS_S3_CONTENT_PREFIX = os.environ.get('AWS_S3_CONTENT_PREFIX', 'content/')
 
 s3 = boto3.client(
    "s3",
    aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-   aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY')
+   aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+   endpoint_url=AWS_S3_ENDPOINT_URL,
+   # One pooled connection per part upload thread of every file uploaded at once
+   config=botocore.config.Config(max_pool_connections=AWS_S3_PART_CONCURRENCY * AWS_S3_FILE_CONCURRENCY)
+)
+
+transfer_config = TransferConfig(
+    multipart_threshold=AWS_S3_PART_SIZE_MB * MB,
+    multipart_chunksize=AWS_S3_PART_SIZE_MB * MB,
+    max_concurrency=AWS_S3_PART_CONCURRENCY,
+    use_threads=True
 )
 
-def upload_file_to_s3(file, bucket_name, acl="public-read"):
-    s3_location = f'https://{bucket_name}.s3.amazonaws.com/'
+class UploadProgress():
+    """boto3 transfer callback that keeps the bytes sent and the throughput of one upload"""
+
+    def __init__(self, key):
+        self.key = key
+        self.sha256 = None
+        self.size = None
+        # True when the content was already in the bucket and nothing was sent
+        self.deduplicated = False
+        self.bytes_transferred = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        # Called from the part upload threads
+        with self._lock:
+            self.bytes_transferred += bytes_amount
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        return self.bytes_transferred / elapsed if elapsed > 0 else 0
+
+    def serialize(self):
+        return {
+            "key": self.key,
+            "sha256": self.sha256,
+            "deduplicated": self.deduplicated,
+            "bytes": self.bytes_transferred,
+            "seconds": round(self.elapsed, 3),
+            "mb_per_second": round(self.throughput / MB, 2)
+        }
+
+def get_s3_location(bucket_name):
+    if AWS_S3_ENDPOINT_URL:
+        return f'{AWS_S3_ENDPOINT_URL.rstrip("/")}/{bucket_name}/'
+    return f'https://{bucket_name}.s3.amazonaws.com/'
+
+def hash_file(file):
+    """sha256 and size of an uploaded file, read in parts from werkzeug's spooled copy
+    and rewound for the upload. That is a second local read of the file, on purpose:
+    the key must be known before sending anything so a duplicate isn't sent at all,
+    where hashing while uploading would send every duplicate and then copy it"""
+    digest = hashlib.sha256()
+    size = 0
+    file.seek(0)
+    for chunk in iter(lambda: file.read(AWS_S3_PART_SIZE_MB * MB), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return digest.hexdigest(), size
+
+def build_content_key(sha256, filename):
+    # The extension keeps the object's URL recognisable to browsers and players
+    extension = os.path.splitext(secure_filename(filename or ''))[1].lower()[:16]
+    return f'{AWS_S3_CONTENT_PREFIX}{sha256[:2]}/{sha256}{extension}'
+
+def find_object(bucket_name, key):
+    try:
+        return s3.head_object(Bucket=bucket_name, Key=key)
+    except botocore.exceptions.ClientError:
+        # 404, or 403 without s3:ListBucket: upload it
+        return None
+
+def upload_file_to_s3(file, bucket_name, acl="public-read", progress=None):
+    """Stores the file under its content hash. When the bucket already has that content,
+    from another order or a retried request, the upload is skipped"""
+    s3_location = get_s3_location(bucket_name)
+    progress = progress or UploadProgress(file.filename)
+    try:
+        progress.sha256, progress.size = hash_file(file)
+        progress.key = build_content_key(progress.sha256, file.filename)
+        existing = find_object(bucket_name, progress.key)
+        if existing is not None and existing.get('ContentLength') == progress.size:
+            progress.deduplicated = True
+        else:
+            s3.upload_fileobj(
+                file,
+                bucket_name,
+                progress.key,
+                ExtraArgs={
+                    "ACL": acl,
+                    "ContentType": file.content_type
+                },
+                Config=transfer_config,
+                Callback=progress
+            )
+    except Exception as e:
+        print("Something Happened: ", e)
+        return None
+    finally:
+        progress.finish()
+
+    print("S3 upload: ", progress.serialize())
+    if progress.deduplicated:
+        S3_UPLOAD_DEDUPLICATED.inc()
+    else:
+        S3_UPLOAD_BYTES.inc(progress.bytes_transferred)
+        S3_UPLOAD_DURATION.observe(progress.elapsed)
+    return "{}{}".format(s3_location, progress.key)
+
+@timed('s3')
+def upload_files_to_s3(files, bucket_name, acl="public-read"):
+    """Uploads several files at once, each in parallel parts. Returns (file, url, progress) per file, url is None on failure"""
+    progresses = [UploadProgress(file.filename) for file in files]
+    with ThreadPoolExecutor(max_workers=AWS_S3_FILE_CONCURRENCY) as executor:
+        urls = list(executor.map(
+            lambda file, progress: upload_file_to_s3(file, bucket_name, acl, progress),
+            files, progresses
+        ))
+    return list(zip(files, urls, progresses))
+
+def is_allowed_content_type(content_type):
+    return any(content_type.startswith(allowed) for allowed in AWS_S3_ALLOWED_CONTENT_TYPES)
+
+def build_upload_key(prefix, filename):
+    # A random segment keeps two uploads with the same file name apart
+    return f'{prefix}/{uuid.uuid4().hex}/{secure_filename(filename) or "file"}'
+
+@timed('s3')
+def create_presigned_upload(bucket_name, key, content_type, size, acl="public-read"):
+    """Presigned POST the client uses to send the file straight to the bucket. S3 rejects
+    the upload if the body is bigger than size or the content type differs"""
     try:
-        s3.upload_fileobj(
-            file,
+        return s3.generate_presigned_post(
             bucket_name,
-            file.filename,
-            ExtraArgs={
-                "ACL": acl,
-                "ContentType": file.content_type
-            }
+            key,
+            Fields={"acl": acl, "Content-Type": content_type},
+            Conditions=[
+                {"acl": acl},
+                {"Content-Type": content_type},
+                ["content-length-range", 1, size]
+            ],
+            ExpiresIn=AWS_S3_UPLOAD_URL_EXPIRATION
         )
     except Exception as e:
         print("Something Happened: ", e)
         return None
 
-    return "{}{}".format(s3_location, file.filename)
\ No newline at end of file
+@timed('s3')
+def get_uploaded_object(bucket_name, key):
+    return find_object(bucket_name, key)
@@ -1,13 +1,25 @@
 import os
+import csv
+import json
+import time
+import random
+import secrets
+import datetime
 from getpass import getpass
+from concurrent.futures import ProcessPoolExecutor
 
 import click
 from flask import Flask
 from flask.cli import with_appcontext
-from sqlalchemy import create_engine, Table
+from sqlalchemy import create_engine, Table, text
+from sqlalchemy.dialects import postgresql, sqlite
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from models import User, Role, Status, DBManager
+from models import (
+    db, User, Role, Status, Order, Document, Address, DBManager, ROLES, STATUSES, TableVersion, OrderChange, OrderStat,
+    ArchivedOrder, ArchivedDocument
+)
+from outbox import get_transport, deliver_pending_emails
 
 
 @click.command()
@@ -57,6 +69,8 @@ def create_roles():
         role = Role(id=Role.HELPER_ROLE_ID, name="Helper")
         role.save()
     DBManager.commitSession()
+    # Other processes reload it when they see the new role TableVersion
+    ROLES.invalidate()
     return
 
 @click.command()
@@ -81,4 +95,423 @@ def create_statuses():
         status = Status(id=Status.COMPLETED_STATUS_ID, name="Completed")
         status.save()
     DBManager.commitSession()
+    # Other processes reload it when they see the new status TableVersion
+    STATUSES.invalidate()
     return
+
+@click.command()
+@with_appcontext
+def check_indexes():
+    """Run EXPLAIN on the listing queries and fail if one of them does not use its index"""
+    queries = {
+        'ix_order_active_created_at_id': Order.query.filter(Order.active == True).order_by(Order.created_at.desc(), Order.id.desc()).limit(50),
+        'ix_order_active_helper_id_created_at_id': Order.query.filter(Order.active == True, Order.helper_id == 1, Order.status_id != Status.REJECTED_STATUS_ID).order_by(Order.created_at.desc(), Order.id.desc()).limit(50),
+        'ix_order_active_status_id_created_at_id': Order.query.filter(Order.active == True, Order.status_id == Status.PENDING_STATUS_ID).order_by(Order.created_at.desc(), Order.id.desc()).limit(50),
+        'ix_user_active_id': User.query.filter(User.is_active == True).order_by(User.id).limit(50),
+        'ix_user_role_id_id': User.query.filter(User.role_id == Role.HELPER_ROLE_ID).order_by(User.id).limit(50),
+        'ix_user_reset_password_token': User.query.filter(User.reset_password_token == 'token'),
+        'ix_document_order_id': Document.query.filter(Document.order_id == 1),
+        'ix_order_cold_status_changed_at': Order.query.filter(db.or_(Order.active == False, Order.status_id == Status.COMPLETED_STATUS_ID), Order.status_changed_at < datetime.datetime(2000, 1, 1)).order_by(Order.status_changed_at).limit(500),
+        'ix_order_change_helper_id_txid_id': db.session.query(OrderChange.order_id).filter(OrderChange.helper_id == 1, db.tuple_(OrderChange.txid, OrderChange.id) > db.tuple_(0, 0)).order_by(OrderChange.txid, OrderChange.id).limit(100),
+    }
+
+    if db.engine.dialect.name == 'sqlite':
+        explain = 'EXPLAIN QUERY PLAN '
+    else:
+        explain = 'EXPLAIN '
+        # Small tables are always cheaper to scan, so ask for the plan as if they were big
+        db.session.execute(text('SET LOCAL enable_seqscan = off'))
+
+    missing = []
+    for index_name, query in queries.items():
+        statement = query.statement.compile(db.engine, compile_kwargs={"literal_binds": True})
+        plan = db.session.execute(text(explain + str(statement))).fetchall()
+        plan = ' '.join(str(column) for row in plan for column in row)
+        used = index_name in plan
+        print(f'{"OK" if used else "MISSING"} {index_name}: {plan}')
+        if not used:
+            missing.append(index_name)
+    db.session.rollback()
+
+    if missing:
+        raise click.ClickException('Indexes not used: ' + ', '.join(missing))
+
+@click.command()
+@click.option('--batch-size', default=50, help='Emails sent per batch')
+@click.option('--interval', default=5.0, help='Seconds to wait when the outbox is empty')
+@click.option('--transport', default=None, help='sendgrid or file (defaults to MAIL_TRANSPORT)')
+@click.option('--once', is_flag=True, help='Drain the due emails and exit')
+@with_appcontext
+def send_emails(batch_size, interval, transport, once):
+    """Deliver the emails queued in the outbox"""
+    mail_transport = get_transport(transport)
+    while True:
+        processed = deliver_pending_emails(mail_transport, batch_size)
+        if processed:
+            print(f'{processed} emails processed')
+        elif once:
+            return
+        else:
+            time.sleep(interval)
+
+@click.command()
+@click.option('--batch-size', default=10000, help='Rows deleted per statement')
+@with_appcontext
+def compact_order_changes(batch_size):
+    """Delete the order changes superseded by a later one for the same order and helper.
+    The latest change of each, in commit order, stays, so no client cursor is ever invalidated"""
+    newer = db.aliased(OrderChange)
+    superseded = db.session.query(OrderChange.id).filter(
+        db.session.query(newer.id).filter(
+            newer.order_id == OrderChange.order_id, newer.helper_id == OrderChange.helper_id,
+            db.tuple_(newer.txid, newer.id) > db.tuple_(OrderChange.txid, OrderChange.id)
+        ).exists()
+    )
+    deleted = 0
+    while True:
+        change_ids = [change_id for change_id, in superseded.limit(batch_size)]
+        if not change_ids:
+            break
+        OrderChange.query.filter(OrderChange.id.in_(change_ids)).delete(synchronize_session=False)
+        DBManager.commitSession()
+        deleted += len(change_ids)
+    print(f'{deleted} order changes deleted')
+
+@click.command()
+@with_appcontext
+def reconcile_order_stats():
+    """Recount the active orders per status and helper and fix the summary table"""
+    if db.engine.dialect.name == 'postgresql':
+        # Transitions wait for the recount instead of changing the counts under it
+        db.session.execute(text('LOCK TABLE order_stat IN EXCLUSIVE MODE'))
+    actual = {
+        (status_id, helper_id): orders
+        for status_id, helper_id, orders in db.session.query(Order.status_id, Order.helper_id, db.func.count()).filter(Order.active == True).group_by(Order.status_id, Order.helper_id)
+    }
+    stored = {(stat.status_id, stat.helper_id): stat for stat in OrderStat.query}
+
+    drifted = 0
+    for key in sorted(set(actual) | set(stored)):
+        orders = actual.get(key, 0)
+        stat = stored.get(key)
+        if stat is None:
+            stat = OrderStat(status_id=key[0], helper_id=key[1], orders=0)
+            db.session.add(stat)
+        if stat.orders != orders:
+            print(f'Status {key[0]}, helper {key[1]}: {stat.orders} -> {orders}')
+            stat.orders = orders
+            drifted += 1
+    if drifted:
+        TableVersion.bump(['order'])
+    DBManager.commitSession()
+    print(f'{drifted} order stats corrected')
+
+def archive_order_batch(cutoff, batch_size):
+    """Moves one batch of cold orders and their documents to the archive tables, in
+    its own short transaction. Returns the number of orders moved"""
+    cold = db.session.query(Order.id, Order.helper_id, Order.status_id, Order.active).filter(
+        db.or_(Order.active == False, Order.status_id == Status.COMPLETED_STATUS_ID),
+        Order.status_changed_at < cutoff,
+    ).order_by(Order.status_changed_at).limit(batch_size).with_for_update(skip_locked=True).all()
+    if not cold:
+        DBManager.commitSession()
+        return 0
+
+    order_ids = [order.id for order in cold]
+    order_table, document_table = Order.__table__, Document.__table__
+    order_columns = [column.name for column in order_table.columns]
+    document_columns = [column.name for column in document_table.columns]
+    db.session.execute(ArchivedOrder.__table__.insert().from_select(order_columns, db.select(*order_table.c).where(order_table.c.id.in_(order_ids))))
+    db.session.execute(ArchivedDocument.__table__.insert().from_select(document_columns, db.select(*document_table.c).where(document_table.c.order_id.in_(order_ids))))
+    db.session.execute(document_table.delete().where(document_table.c.order_id.in_(order_ids)))
+    db.session.execute(order_table.delete().where(order_table.c.id.in_(order_ids)))
+
+    # The DELETE skips the flush: move the stats and tell the clients here
+    counts = {}
+    for order in cold:
+        if order.active:
+            counts[(order.status_id, order.helper_id)] = counts.get((order.status_id, order.helper_id), 0) - 1
+    OrderStat.add(counts)
+    OrderChange.record([(order.id, order.helper_id) for order in cold])
+    TableVersion.bump(['order', 'document'])
+    DBManager.commitSession()
+    return len(cold)
+
+@click.command()
+@click.option('--older-than', default=180, help='Days since the order was completed or deleted')
+@click.option('--batch-size', default=500, help='Orders moved per transaction')
+@click.option('--pause', default=0.1, help='Seconds between batches, to leave room for the live traffic')
+@click.option('--interval', default=None, type=float, help='Keep running and archive again every this many seconds')
+@with_appcontext
+def archive_orders(older_than, batch_size, pause, interval):
+    """Move the orders deleted or completed more than --older-than days ago, with their
+    documents, to the archive tables"""
+    while True:
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=older_than)
+        archived = 0
+        while True:
+            moved = archive_order_batch(cutoff, batch_size)
+            archived += moved
+            if moved < batch_size:
+                break
+            time.sleep(pause)
+        print(f'{archived} orders archived')
+        if interval is None:
+            return
+        time.sleep(interval)
+
+def hash_password(password):
+    # Module level so the process pool can pickle it
+    return generate_password_hash(password or secrets.token_urlsafe(16), method='sha256')
+
+def read_user_rows(path, file_format):
+    """(line number, row) for every user in the file; row is None for a line that
+    isn't valid JSON"""
+    with open(path, newline='') as users_file:
+        if file_format == 'csv':
+            reader = csv.DictReader(users_file)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line_number, line in enumerate(users_file, start=1):
+                if line.strip():
+                    try:
+                        yield line_number, json.loads(line)
+                    except ValueError:
+                        yield line_number, None
+
+def parse_user_row(row, role_ids):
+    """Columns of the user to insert, but the password, or ValueError with the reason
+    the row is skipped"""
+    if not isinstance(row, dict):
+        raise ValueError('not a JSON object')
+    email, full_name, password = row.get('email'), row.get('full_name'), row.get('password')
+    if not isinstance(email, str) or not email.strip():
+        raise ValueError('missing email')
+    if not isinstance(full_name, str) or not full_name.strip():
+        raise ValueError('missing full_name')
+    if password is not None and not isinstance(password, str):
+        raise ValueError('password must be text')
+    phone = str(row.get('phone') or '')
+    role_id = row.get('role_id') or Role.HELPER_ROLE_ID
+    try:
+        role_id = int(role_id)
+    except (TypeError, ValueError):
+        raise ValueError(f'role_id {role_id!r} is not a number')
+    if role_id not in role_ids:
+        raise ValueError(f'role_id {role_id} does not exist')
+    email = email.strip()
+    for name, value in (('email', email), ('full_name', full_name), ('phone', phone)):
+        if len(value) > User.__table__.c[name].type.length:
+            raise ValueError(f'{name} is too long')
+    return {
+        "email": email,
+        "full_name": full_name,
+        "phone": phone,
+        "role_id": role_id,
+        "is_active": True,
+    }
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def upsert_users(rows, update_passwords, reactivate):
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(User.__table__)
+    elif dialect == 'sqlite':
+        statement = sqlite.insert(User.__table__)
+    else:
+        raise click.ClickException(f'import-users does not support {dialect}')
+    # New users are inserted active; existing ones keep is_active unless reactivated
+    columns = ['full_name', 'phone', 'role_id']
+    if update_passwords:
+        columns.append('password')
+    if reactivate:
+        columns.append('is_active')
+    statement = statement.on_conflict_do_update(
+        index_elements=['email'],
+        set_={column: statement.excluded[column] for column in columns}
+    )
+    # One executemany per batch; psycopg2 sends it as multi-row INSERT ... VALUES pages
+    db.session.execute(statement, rows)
+
+@click.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), default=None, help='Defaults to the file extension')
+@click.option('--batch-size', default=1000, help='Users inserted per statement')
+@click.option('--workers', default=None, type=int, help='Password hashing processes (defaults to the CPU count)')
+@click.option('--update-passwords', is_flag=True, help='Overwrite the password of users that already exist')
+@click.option('--reactivate', is_flag=True, help='Reactivate the users in the file that were deactivated')
+@with_appcontext
+def import_users(path, file_format, batch_size, workers, update_passwords, reactivate):
+    """Create or update users from a CSV or NDJSON file with email, password, full_name, phone and role_id.
+    Users without password get a random one and can set theirs with the reset password email.
+    Deactivated users stay deactivated unless --reactivate is given. Rows without email or
+    full_name, or with an unknown role_id, are skipped and reported with their line number"""
+    file_format = file_format or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+    role_ids = {role_id for role_id, in db.session.query(Role.id)}
+    started = time.monotonic()
+    imported, skipped = 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch in batches(read_user_rows(path, file_format), batch_size):
+            # Checked before hashing, a bad row costs no hash and doesn't fail the batch
+            valid = []
+            for line_number, row in batch:
+                try:
+                    valid.append((parse_user_row(row, role_ids), row.get('password')))
+                except ValueError as e:
+                    print(f'Line {line_number} skipped: {e}')
+                    skipped += 1
+            if not valid:
+                continue
+            passwords = executor.map(hash_password, [password for _, password in valid], chunksize=max(1, len(valid) // 32))
+            # Keyed by email: Postgres can't upsert the same row twice in one INSERT
+            rows = {user["email"]: dict(user, password=password) for (user, _), password in zip(valid, passwords)}
+            upsert_users(list(rows.values()), update_passwords, reactivate)
+            TableVersion.bump(['user'])
+            DBManager.commitSession()
+            imported += len(rows)
+            print(f'{imported} users imported')
+    print(f'{imported} users imported, {skipped} rows skipped, in {time.monotonic() - started:.1f}s')
+
+# Share of orders per status in production, used by seed-synthetic
+SYNTHETIC_STATUS_WEIGHTS = {
+    Status.PENDING_STATUS_ID: 8,
+    Status.REJECTED_STATUS_ID: 5,
+    Status.PROCESSING_STATUS_ID: 15,
+    Status.READY_STATUS_ID: 7,
+    Status.APPROVED_STATUS_ID: 10,
+    Status.COMPLETED_STATUS_ID: 55,
+}
+SYNTHETIC_CITIES = ['Madrid', 'Barcelona', 'Valencia', 'Sevilla', 'Zaragoza', 'Málaga', 'Bilbao', 'Valladolid']
+SYNTHETIC_ITEMS = ['Pantalla protectora', 'Salvaorejas', 'Abrebotones', 'Prótesis de mano', 'Adaptador de cubiertos', 'Soporte de tablet']
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+def insert_rows(model, rows, batch_size):
+    for batch in batches(rows, batch_size):
+        db.session.execute(model.__table__.insert(), batch)
+        DBManager.commitSession()
+
+def reset_sequence(model):
+    # Rows are inserted with explicit ids, move the Postgres sequence past them
+    if db.engine.dialect.name == 'postgresql':
+        table = model.__table__.name
+        db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), (SELECT max(id) FROM \"{table}\"))"))
+
+@click.command()
+@click.option('--users', default=1000, help='Helpers and managers to create')
+@click.option('--orders', default=100000, help='Orders to create')
+@click.option('--days', default=730, help='Spread of order created_at, in days before now')
+@click.option('--seed', default=42, help='Random seed, the same seed generates the same data')
+@click.option('--batch-size', default=10000, help='Rows inserted per statement')
+@click.pass_context
+@with_appcontext
+def seed_synthetic(ctx, users, orders, days, seed, batch_size):
+    """Generate users, addresses, orders and documents for load and scale testing"""
+    ctx.invoke(create_roles)
+    ctx.invoke(create_statuses)
+    generator = random.Random(seed)
+    started = time.monotonic()
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    # Every synthetic user shares one password, hashing it per user would dominate the run
+    password = generate_password_hash('synthetic', method='sha256')
+
+    first_user_id = next_id(User)
+    user_rows = [
+        {
+            "id": first_user_id + i,
+            "email": f'synthetic-{seed}-{first_user_id + i}@example.org',
+            "password": password,
+            "full_name": f'Voluntario {first_user_id + i}',
+            "phone": f'6{generator.randint(0, 99999999):08d}',
+            "is_active": generator.random() > 0.03,
+            "role_id": Role.MANAGER_ROLE_ID if i % 50 == 0 else Role.HELPER_ROLE_ID,
+        }
+        for i in range(users)
+    ]
+    insert_rows(User, user_rows, batch_size)
+    helper_ids = [row["id"] for row in user_rows if row["role_id"] == Role.HELPER_ROLE_ID]
+    manager_ids = [row["id"] for row in user_rows if row["role_id"] == Role.MANAGER_ROLE_ID] or helper_ids
+    print(f'{len(user_rows)} users')
+
+    first_address_id = next_id(Address)
+    address_rows = [
+        {
+            "id": first_address_id + i,
+            "address": f'Calle {generator.randint(1, 500)}, {generator.randint(1, 99)}',
+            "city": generator.choice(SYNTHETIC_CITIES),
+            "country": 'España',
+            "cp": f'{generator.randint(1000, 52999):05d}',
+            "user_id": row["id"],
+        }
+        for i, row in enumerate(user_rows)
+    ]
+    insert_rows(Address, address_rows, batch_size)
+    print(f'{len(address_rows)} addresses')
+
+    statuses = list(SYNTHETIC_STATUS_WEIGHTS)
+    weights = list(SYNTHETIC_STATUS_WEIGHTS.values())
+    first_order_id = next_id(Order)
+    first_document_id = next_id(Document)
+    document_count = 0
+
+    def order_rows():
+        for i in range(orders):
+            status_id = generator.choices(statuses, weights)[0]
+            # Skewed towards recent orders, like the real traffic
+            created_at = now - datetime.timedelta(days=days * generator.random() ** 2, seconds=generator.randint(0, 86399))
+            address_id = first_address_id + generator.randrange(len(address_rows)) if status_id == Status.COMPLETED_STATUS_ID else None
+            yield {
+                "id": first_order_id + i,
+                "description": f'{generator.choice(SYNTHETIC_ITEMS)} x{generator.randint(1, 200)}',
+                "long_description": ' '.join(generator.choice(SYNTHETIC_ITEMS) for _ in range(generator.randint(0, 40))) or None,
+                "active": generator.random() > 0.02,
+                "created_at": created_at,
+                "status_changed_at": created_at,
+                "helper_id": generator.choice(helper_ids),
+                "status_id": status_id,
+                "address_delivery_id": address_id,
+                "address_pickup_id": address_id,
+            }
+
+    def document_rows(order_batch):
+        nonlocal document_count
+        for order in order_batch:
+            if order["status_id"] in (Status.PENDING_STATUS_ID, Status.REJECTED_STATUS_ID):
+                continue
+            for _ in range(generator.randint(0, 3)):
+                document_id = first_document_id + document_count
+                document_count += 1
+                yield {
+                    "id": document_id,
+                    "name": f'video-{document_id}.mp4',
+                    "url": f'https://example.org/orders/{order["id"]}/video-{document_id}.mp4',
+                    "order_id": order["id"],
+                    "user_id": generator.choice(manager_ids + [order["helper_id"]]),
+                }
+
+    for count, order_batch in enumerate(batches(order_rows(), batch_size), start=1):
+        db.session.execute(Order.__table__.insert(), order_batch)
+        documents = list(document_rows(order_batch))
+        if documents:
+            db.session.execute(Document.__table__.insert(), documents)
+        DBManager.commitSession()
+        print(f'{min(count * batch_size, orders)} orders, {document_count} documents')
+
+    for model in (User, Address, Order, Document):
+        reset_sequence(model)
+    TableVersion.bump(['user', 'address', 'order', 'document'])
+    DBManager.commitSession()
+    # The rows were inserted without the ORM, so the order stats are recounted
+    ctx.invoke(reconcile_order_stats)
+    print(f'Synthetic data generated in {time.monotonic() - started:.1f}s')
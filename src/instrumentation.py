@@ -0,0 +1,119 @@
+"""
+Per-request timing: SQL statements, S3 and mail time, reported as a Server-Timing
+header and one JSON log line per request. Enabled with REQUEST_TIMING=true; when it
+is off no event listener or request hook is installed
+"""
+import json
+import time
+import functools
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+enabled = False
+
+class RequestTiming():
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.durations = {}
+        self.counts = {}
+
+    def add(self, category, seconds):
+        self.durations[category] = self.durations.get(category, 0) + seconds
+        self.counts[category] = self.counts.get(category, 0) + 1
+
+    def serialize(self):
+        total = time.perf_counter() - self.started_at
+        timings = {category: round(seconds * 1000, 2) for category, seconds in self.durations.items()}
+        timings['app'] = round((total - sum(self.durations.values())) * 1000, 2)
+        timings['total'] = round(total * 1000, 2)
+        return timings
+
+def current_timing():
+    if enabled and has_request_context():
+        return g.get('request_timing')
+    return None
+
+def timed(category):
+    """Adds the time spent in the decorated function to the request's category"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            timing = current_timing()
+            if timing is None:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timing.add(category, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+class StatementCounter():
+    """Counts the SQL statements the engine runs inside the with block, for the tests and benchmarks"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self)
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('request_timing_started', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['request_timing_started'].pop()
+    timing = current_timing()
+    if timing is not None:
+        timing.add('db', time.perf_counter() - started)
+
+def handle_error(exception_context):
+    # after_cursor_execute is not called for failed statements
+    started = exception_context.connection.info.get('request_timing_started') if exception_context.connection is not None else None
+    if started:
+        started.pop()
+
+def start_request_timing():
+    g.request_timing = RequestTiming()
+
+def add_server_timing(response):
+    timing = g.get('request_timing')
+    if timing is None:
+        return response
+    timings = timing.serialize()
+    response.headers['Server-Timing'] = ', '.join(
+        f'{category};dur={duration}' + (f';desc="calls={timing.counts[category]}"' if category in timing.counts else '')
+        for category, duration in timings.items()
+    )
+    response.headers['Timing-Allow-Origin'] = '*'
+    print(json.dumps({
+        "event": "request_timing",
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "ms": timings,
+        "calls": timing.counts,
+    }))
+    return response
+
+def init_instrumentation(app):
+    global enabled
+    if not app.config.get('REQUEST_TIMING'):
+        return
+    enabled = True
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Engine, 'handle_error', handle_error)
+    app.before_request(start_request_timing)
+    app.after_request(add_server_timing)
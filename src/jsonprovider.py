@@ -0,0 +1,90 @@
+"""
+Drop-in replacement for flask.jsonify with a pluggable encoder: orjson by default,
+the standard json module with JSON_PROVIDER=json. Both keep Flask's output format
+(sorted keys, HTTP dates, Decimal as string)
+"""
+import os
+import json
+import uuid
+import decimal
+import datetime
+import orjson
+from flask import current_app
+from werkzeug.http import http_date
+from instrumentation import timed
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def format_datetime(value):
+    # Same output as werkzeug's http_date, which flask.json uses and the frontend
+    # parses, without the time tuple round trip
+    if value is None:
+        return None
+    if not isinstance(value, datetime.datetime):
+        return http_date(value.timetuple())
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return (
+        f'{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} {value.year:04d} '
+        f'{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT'
+    )
+
+def default(value):
+    if isinstance(value, datetime.date):
+        return format_datetime(value)
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+class StdlibJSONProvider():
+    name = 'json'
+
+    def dumps(self, data, pretty=False):
+        if pretty:
+            return json.dumps(data, default=default, sort_keys=True, indent=2, separators=(', ', ': '))
+        return json.dumps(data, default=default, sort_keys=True, separators=(',', ':'))
+
+class OrjsonJSONProvider():
+    name = 'orjson'
+
+    def dumps(self, data, pretty=False):
+        # Dates go through default() so they keep Flask's format instead of orjson's ISO 8601
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=default, option=option)
+
+JSON_PROVIDERS = {
+    'json': StdlibJSONProvider,
+    'orjson': OrjsonJSONProvider,
+}
+
+def get_json_provider(name=None):
+    name = name or os.environ.get('JSON_PROVIDER') or 'orjson'
+    if name not in JSON_PROVIDERS:
+        raise ValueError(f'Unknown JSON provider: {name}')
+    return JSON_PROVIDERS[name]()
+
+def init_json_provider(app):
+    app.extensions['json_provider'] = get_json_provider(app.config.get('JSON_PROVIDER'))
+
+@timed('json')
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    elif len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    provider = current_app.extensions.get('json_provider') or get_json_provider()
+    pretty = current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or current_app.debug
+    body = provider.dumps(data, pretty=pretty)
+    if isinstance(body, bytes):
+        body += b'\n'
+    else:
+        body += '\n'
+    return current_app.response_class(body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
@@ -1,24 +1,15 @@
 import os
 from flask import url_for
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from models import Status
+from models import STATUSES
+from outbox import queue_email
 
 FRONTEND_URL = os.environ.get('FRONTEND_URL')
 MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER')
 A3D_LOGO = 'https://ayudame3d.org/wp-content/uploads/2020/10/logobannerwhite_182x50.png'
 
-def __send_email(message):
-    try:
-        mail = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
-        response = mail.send(message)
-        print(response.status_code)
-        print(response.body)
-        print(response.headers)
-        return True
-    except Exception as e:
-        print("Sendgrid error: ", str(e))
-        return False
+def __send_email(to_email, subject, html_content):
+    # Delivered later by the `flask send-emails` worker, see outbox.py
+    return queue_email(to_email, subject, html_content) is not None
 
 def __get_template_message(message):
     header = f"""
@@ -36,9 +27,8 @@ def __get_template_message(message):
 
 def new_order_mail(helper, order):
     url = f'{FRONTEND_URL}/orders/{order.id}'
-    msg = Mail(
-        from_email=MAIL_DEFAULT_SENDER,
-        to_emails=helper.email,
+    return __send_email(
+        to_email=helper.email,
         subject='Nueva solicitud de Ayúdame3D',
         html_content=(
             __get_template_message(
@@ -48,12 +38,10 @@ def new_order_mail(helper, order):
             )
         )
     )
-    return __send_email(msg)
 
 def order_acceptance_mail(order):
-    msg = Mail(
-        from_email=MAIL_DEFAULT_SENDER,
-        to_emails=MAIL_DEFAULT_SENDER,
+    return __send_email(
+        to_email=MAIL_DEFAULT_SENDER,
         subject=f'La solicitud {order.id} ha sido aceptada',
         html_content=(
             __get_template_message(
@@ -62,12 +50,10 @@ def order_acceptance_mail(order):
             )
         )
     )
-    return __send_email(msg)
 
 def order_rejection_mail(order):
-    msg = Mail(
-        from_email=MAIL_DEFAULT_SENDER,
-        to_emails=MAIL_DEFAULT_SENDER,
+    return __send_email(
+        to_email=MAIL_DEFAULT_SENDER,
         subject=f'ATENCIÓN: El pedido {order.id} ha sido rechazado',
         html_content=(
             __get_template_message(
@@ -76,42 +62,47 @@ def order_rejection_mail(order):
             )
         )
     )
-    return __send_email(msg)
 
 def order_status_update_mail(order):
-    status = Status.query.get(order.status_id) 
-    msg = Mail(
-        from_email=MAIL_DEFAULT_SENDER,
-        to_emails=MAIL_DEFAULT_SENDER,
+    status = STATUSES.get(order.status_id)
+    return __send_email(
+        to_email=MAIL_DEFAULT_SENDER,
         subject=f'El pedido {order.id} ha cambiado de estado',
         html_content=(f'<h1>El pedido {order.id} ha cambiado de estado</h1>'
-                    f'<p>El pedido {order.id} ha sido cambiado a {status.name}.</p>'
+                    f'<p>El pedido {order.id} ha sido cambiado a {status["name"]}.</p>'
+        )
+    )
+
+def orders_status_update_mail(order_ids, status_id):
+    status = STATUSES.get(status_id)
+    orders_list = ''.join(f'<li><a href="{FRONTEND_URL}/orders/{order_id}">Pedido {order_id}</a></li>' for order_id in order_ids)
+    return __send_email(
+        to_email=MAIL_DEFAULT_SENDER,
+        subject=f'{len(order_ids)} pedidos han cambiado a {status["name"]}',
+        html_content=(f'<h1>{len(order_ids)} pedidos han cambiado de estado</h1>'
+                    f'<p>Los siguientes pedidos han sido cambiados a {status["name"]}:</p>'
+                    f'<ul>{orders_list}</ul>'
         )
     )
-    return __send_email(msg)
 
 def order_new_data_mail(order):
-    status = Status.query.get(order.status_id) 
-    msg = Mail(
-        from_email=MAIL_DEFAULT_SENDER,
-        to_emails=MAIL_DEFAULT_SENDER,
+    status = STATUSES.get(order.status_id)
+    return __send_email(
+        to_email=MAIL_DEFAULT_SENDER,
         subject=f'El pedido {order.id} ha sido actualizado',
         html_content=(
             __get_template_message(
                 f'<h1>El pedido {order.id} tiene nuevos datos</h1>'
-                f'<p>El pedido {order.id} ha sido cambiado a {status.name}.</p>'
+                f'<p>El pedido {order.id} ha sido cambiado a {status["name"]}.</p>'
             )
         )
     )
-    return __send_email(msg)
 
 def order_complete_mail(order):
     video_url = 'https://youtu.be/fGFLQlRpeQI'
     form_url = 'https://docs.google.com/forms/d/e/1FAIpQLSfaUth4_hhjTopk594-ia6RVkkq2Fq9mcRRhAq8ggW0SbBMgA/viewform?usp=sf_link'
-    status = Status.query.get(order.status_id) 
-    msg = Mail(
-        from_email=MAIL_DEFAULT_SENDER,
-        to_emails=helper.email,
+    return __send_email(
+        to_email=order.helper.email,
         subject=f'Ayúdame 3D ha aceptado tu video en el pedido {order.id}',
         html_content=(
             __get_template_message(
@@ -122,14 +113,11 @@ def order_complete_mail(order):
             )
         )
     )
-    return __send_email(msg)
 
 def new_password_email(user):
     url = f'{FRONTEND_URL}reset-password?token={user.reset_password_token}'
-    print(url)
-    msg = Mail(
-        from_email=MAIL_DEFAULT_SENDER,
-        to_emails=user.email,
+    return __send_email(
+        to_email=user.email,
         subject='Restablecer contraseña de Ayúdame3D',
         html_content=(
             __get_template_message(
@@ -139,4 +127,3 @@ def new_password_email(user):
             )
         )
     )
-    return __send_email(msg)
@@ -2,24 +2,53 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
+import json
+import hashlib
 import datetime
-from flask import Flask, request, jsonify, url_for
+import functools
+from flask import Flask, request, url_for, make_response, g, Response
 from flask_migrate import Migrate
 from flask_swagger import swagger
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
+from sqlalchemy.pool import NullPool
+from jsonprovider import jsonify, init_json_provider
+from instrumentation import init_instrumentation
+from metrics import init_metrics, InstrumentedQueuePool
+from orderevents import (
+    init_order_events, stream_order_events, queue_order_events, order_event,
+    STATUS_EVENTS, BROADCASTER, SSE_MAX_STREAMS
+)
+from utils import (
+    APIException, generate_sitemap, get_page_limit, decode_cursor,
+    keyset_page, paginated_response, parse_datetime_arg, encode_cursor,
+    NEXT_CURSOR_HEADER, MAX_PAGE_SIZE
+)
 # from admin import setup_admin
-from models import db, User, Order, Document, Role, DBManager, Status, Address
-from amazonawss3 import upload_file_to_s3
+from models import (
+    db, User, Order, Document, Role, DBManager, Status, Address, ROLES, STATUSES,
+    UserAccessCache, TableVersion, OrderChange, OrderStat, OrderStatusTime,
+    ArchivedOrder, REPLICA_BIND, replica_enabled, wrote_recently, search_terms, match_orders, locked_orders
+)
+from amazonawss3 import (
+    upload_files_to_s3, build_upload_key, create_presigned_upload,
+    get_uploaded_object, get_s3_location, is_allowed_content_type, AWS_S3_MAX_UPLOAD_MB
+)
 from flask_jwt_extended import (
     JWTManager, jwt_required, create_access_token,
-    get_jwt_identity
+    get_jwt_identity, get_jwt
 )
 from mailer import (
     new_order_mail, new_password_email, order_acceptance_mail,
-    order_rejection_mail, order_status_update_mail, order_new_data_mail
+    order_rejection_mail, order_status_update_mail, order_new_data_mail,
+    orders_status_update_mail
+)
+from commands import (
+    create_admin, create_roles, create_statuses, check_indexes, send_emails,
+    import_users, seed_synthetic, compact_order_changes,
+    reconcile_order_stats, archive_orders
 )
-from commands import create_admin, create_roles, create_statuses
 
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -31,18 +60,76 @@ if os.environ.get("DATABASE_URL") is not None:
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 
+if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    if os.environ.get('DB_EXTERNAL_POOLER', 'false').lower() == 'true':
+        # PgBouncer or similar does the pooling: a connection per checkout, closed on checkin
+        engine_options = {'poolclass': NullPool}
+    else:
+        # Per process: gunicorn workers x (DB_POOL_SIZE + DB_MAX_OVERFLOW + the LISTEN connection)
+        # must fit in max_connections, 2 x 17 with the defaults; see docs/DEPLOY_PUBLISH_YOUR_APP.md.
+        # By default one connection per web thread that isn't held by an event stream, so
+        # requests never wait for a connection
+        pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+        api_threads = int(os.environ.get('WEB_THREADS', 32)) - SSE_MAX_STREAMS
+        engine_options = {
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': pool_size,
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW') or max(0, api_threads - pool_size)),
+            'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+            # Drops connections closed by the server or a firewall while idle
+            'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true',
+        }
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+    if statement_timeout and app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        engine_options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+if os.environ.get("DATABASE_REPLICA_URL"):
+    # Read-only views marked with @use_replica query it, everything else the primary
+    app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: os.environ.get('DATABASE_REPLICA_URL').replace("postgres://", "postgresql://", 1)}
+# After a write, the user's reads go to the primary for this long (replication lag).
+# The last write travels in Flask's signed session cookie; the frontend sends it with
+# credentials: 'include', so it has to be SameSite=None and Secure across origins
+app.config['REPLICA_READ_YOUR_WRITES_SECONDS'] = float(os.environ.get('REPLICA_READ_YOUR_WRITES_SECONDS', 10))
+app.config['SESSION_COOKIE_SAMESITE'] = os.environ.get('SESSION_COOKIE_SAMESITE', 'None')
+app.config['SESSION_COOKIE_SECURE'] = os.environ.get('SESSION_COOKIE_SECURE', 'true').lower() == 'true'
+app.config['JSON_PROVIDER'] = os.environ.get('JSON_PROVIDER')
+init_json_provider(app)
+app.config['REQUEST_TIMING'] = os.environ.get('REQUEST_TIMING', 'false').lower() == 'true'
+init_instrumentation(app)
+init_metrics(app)
 MIGRATE = Migrate(app, db)
 db.init_app(app)
-CORS(app)
+CORS(app, expose_headers=[NEXT_CURSOR_HEADER, 'ETag'], supports_credentials=True)
 # setup_admin(app)
 
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')  # Change this!
+# Signs the session cookie
+app.secret_key = os.environ.get('FLASK_APP_KEY') or app.config['JWT_SECRET_KEY']
+# Tokens carry the role; those issued before a role change or a deactivation are revoked
+app.config['JWT_ACCESS_TOKEN_EXPIRES'] = datetime.timedelta(minutes=int(os.environ.get('JWT_ACCESS_TOKEN_EXPIRES_MINUTES', 15)))
 jwt = JWTManager(app)
+# postgres (LISTEN/NOTIFY) or local (single process); by default from the database
+app.config['ORDER_EVENTS_BACKEND'] = os.environ.get('ORDER_EVENTS_BACKEND')
+init_order_events(app)
+USER_ACCESS = UserAccessCache(int(os.environ.get('JWT_REVOCATION_REFRESH_SECONDS', 30)))
+
+@jwt.token_in_blocklist_loader
+def check_if_user_access_changed(jwt_header, jwt_payload):
+    return USER_ACCESS.is_revoked(jwt_payload['sub'], jwt_payload)
 
 app.cli.add_command(create_admin)
 app.cli.add_command(create_roles)
 app.cli.add_command(create_statuses)
+app.cli.add_command(check_indexes)
+app.cli.add_command(send_emails)
+app.cli.add_command(import_users)
+app.cli.add_command(seed_synthetic)
+app.cli.add_command(compact_order_changes)
+app.cli.add_command(reconcile_order_stats)
+app.cli.add_command(archive_orders)
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
@@ -55,16 +142,87 @@ def handle_invalid_usage(error):
 # def sitemap():
 #     return generate_sitemap(app)
 
+def get_authenticated_role_id():
+    claims = get_jwt()
+    if 'role_id' in claims:
+        return claims['role_id']
+    # Tokens issued before the role was added to the claims
+    return User.query.get(get_jwt_identity()).role_id
+
+def use_replica(view):
+    """Routes the view's queries to the read replica, if there is one, unless the user
+    wrote recently and the replica may not have the change yet"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if replica_enabled() and not wrote_recently(get_jwt_identity(), app.config['REPLICA_READ_YOUR_WRITES_SECONDS']):
+            g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def conditional_on(*tables, vary_on=None):
+    """Strong ETag from the versions of the tables a view reads, and from vary_on() for
+    views that also depend on something else, such as the time. Answers 304 before
+    running the view when the client already has the current representation"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            versions = TableVersion.get_versions(tables)
+            # Same tables, different user or query string -> different body
+            key = [versions, get_jwt_identity(), request.full_path]
+            if vary_on is not None:
+                key.append(vary_on())
+            etag = hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
+
+def visible_orders():
+    """Active orders the user sees, with the helper_id and status_id filters"""
+    # Load the helper in the same SELECT; role and status come from the lookup caches
+    query = Order.query.options(joinedload(Order.helper)).filter(Order.active == True)
+    if get_authenticated_role_id() == Role.HELPER_ROLE_ID:
+        query = query.filter(Order.helper_id == get_jwt_identity(), Order.status_id != Status.REJECTED_STATUS_ID)
+    else:
+        helper_id = request.args.get('helper_id', type=int)
+        if helper_id is not None:
+            query = query.filter(Order.helper_id == helper_id)
+
+    status_id = request.args.get('status_id', type=int)
+    if status_id is not None:
+        query = query.filter(Order.status_id == status_id)
+    return query
+
+def paginate_users(query):
+    cursor = request.args.get('cursor')
+    if cursor:
+        user_id, = decode_cursor(cursor, int)
+        query = query.filter(User.id > user_id)
+    return keyset_page(query.order_by(User.id), get_page_limit(request.args), lambda user: [user.id])
+
 #========================================================================
 @app.route('/users', methods=['GET'])
 @jwt_required()
+@use_replica
+@conditional_on('user', 'role')
 def users():
-    users = User.query.filter(User.is_active == True).all()
+    query = User.query.filter(User.is_active == True)
+    role_id = request.args.get('role_id', type=int)
+    if role_id is not None:
+        query = query.filter(User.role_id == role_id)
+    users, next_cursor = paginate_users(query)
     usersJson = list(map(lambda user: user.serialize(), users))
-    return jsonify(usersJson), 200
+    return paginated_response(usersJson, next_cursor), 200
 
 @app.route('/users/<int:id>', methods=['GET'])
 @jwt_required()
+@conditional_on('user', 'role')
 def edit_user(id):
     user = User.query.get(id)
     return jsonify(user.serialize()), 200
@@ -98,6 +256,7 @@ def save_user(id):
 
     user.save()
     DBManager.commitSession()
+    USER_ACCESS.invalidate()
 
     return jsonify(user.serialize()), 200
 
@@ -109,6 +268,7 @@ def delete_user(id):
         raise APIException('User not found', status_code=404)
     user.is_active = False
     DBManager.commitSession()
+    USER_ACCESS.invalidate()
     
     return jsonify(user.serialize()), 200
 
@@ -121,8 +281,8 @@ def send_password_email():
         today = dt.strftime("%Y-%m-%d")
         user.reset_password_token = generate_password_hash(user.email+today, method='sha256')
         user.save()
-        DBManager.commitSession()
         new_password_email(user)
+        DBManager.commitSession()
     return jsonify({"status": "ok"}), 200
 
 @app.route('/reset-password', methods=['POST'])
@@ -141,31 +301,192 @@ def reset_password():
 
 @app.route('/roles', methods=['GET'])
 @jwt_required()
+@use_replica
 def roles():
-    roles = Role.query.all()
-    rolesJson = list(map(lambda role: role.serialize(), roles))
-    return jsonify(rolesJson), 200
+    return jsonify(ROLES.all()), 200
 
 @app.route('/status', methods=['GET'])
 @jwt_required()
+@use_replica
 def status():
-    statuses = Status.query.all()
-    statusesJson = list(map(lambda status: status.serialize(), statuses))
-    return jsonify(statusesJson), 200
+    return jsonify(STATUSES.all()), 200
 
 @app.route('/orders', methods=['GET'])
 @jwt_required()
+@use_replica
+@conditional_on('order', 'user', 'role', 'status')
 def orders():
-    user_authenticated_id = get_jwt_identity()
-    user = User.query.get(user_authenticated_id)
-    if user.role_id == Role.HELPER_ROLE_ID:
-        orders = Order.query.filter(Order.helper_id == user_authenticated_id, Order.status_id != Status.REJECTED_STATUS_ID, Order.active == True).order_by(Order.created_at.desc()).all()
-    else:
-        orders = Order.query.filter(Order.active == True).order_by(Order.created_at.desc()).all()
+    query = visible_orders()
+    created_from = parse_datetime_arg(request.args, 'created_from')
+    if created_from is not None:
+        query = query.filter(Order.created_at >= created_from)
+    created_to = parse_datetime_arg(request.args, 'created_to')
+    if created_to is not None:
+        query = query.filter(Order.created_at < created_to)
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        created_at, order_id = decode_cursor(cursor, datetime.datetime.fromisoformat, int)
+        # created_at is read back from the row while it exists, so the comparison uses the
+        # value exactly as the database stored it; the cursor's copy covers an order
+        # archived between pages
+        stored_created_at = db.session.query(Order.created_at).filter(Order.id == order_id).scalar_subquery()
+        cursor_created_at = db.func.coalesce(stored_created_at, created_at)
+        query = query.filter(tuple_(Order.created_at, Order.id) < tuple_(cursor_created_at, order_id))
+    query = query.order_by(Order.created_at.desc(), Order.id.desc())
+
+    orders, next_cursor = keyset_page(query, get_page_limit(request.args), lambda order: [order.created_at.isoformat(), order.id])
+    ordersJson = list(map(lambda order: order.serialize(), orders))
+
+    return paginated_response(ordersJson, next_cursor), 200
 
+@app.route('/orders/archive', methods=['GET'])
+@jwt_required()
+@use_replica
+@conditional_on('order', 'user', 'role', 'status')
+def archived_orders():
+    """Archived orders that weren't deleted, newest first, scoped like GET /orders"""
+    query = ArchivedOrder.query.options(joinedload(ArchivedOrder.helper)).filter(ArchivedOrder.active == True)
+    if get_authenticated_role_id() == Role.HELPER_ROLE_ID:
+        query = query.filter(ArchivedOrder.helper_id == get_jwt_identity(), ArchivedOrder.status_id != Status.REJECTED_STATUS_ID)
+    else:
+        helper_id = request.args.get('helper_id', type=int)
+        if helper_id is not None:
+            query = query.filter(ArchivedOrder.helper_id == helper_id)
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        order_id, = decode_cursor(cursor, int)
+        query = query.filter(ArchivedOrder.id < order_id)
+    orders, next_cursor = keyset_page(query.order_by(ArchivedOrder.id.desc()), get_page_limit(request.args), lambda order: [order.id])
     ordersJson = list(map(lambda order: order.serialize(), orders))
+    return paginated_response(ordersJson, next_cursor), 200
 
-    return jsonify(ordersJson), 200
+SEARCH_DEFAULT_LIMIT = 50
+
+@app.route('/orders/search', methods=['GET'])
+@jwt_required()
+@use_replica
+@conditional_on('order', 'user', 'role', 'status')
+def search_orders():
+    terms = search_terms(request.args.get('q'))
+    if not terms:
+        raise APIException('q must contain at least one word', status_code=400)
+    query = match_orders(visible_orders(), terms, db.engine.dialect.name)
+    orders = query.limit(get_page_limit(request.args, SEARCH_DEFAULT_LIMIT)).all()
+    return jsonify(list(map(lambda order: order.serialize(), orders))), 200
+
+SSE_BUSY_RETRY_SECONDS = 30
+
+@app.route('/orders/events', methods=['GET'])
+# EventSource can't send headers: browsers pass the token as ?jwt=
+@jwt_required(locations=['headers', 'query_string'])
+def order_events():
+    user_authenticated_id = get_jwt_identity()
+    if get_authenticated_role_id() == Role.HELPER_ROLE_ID:
+        # Same scope as GET /orders, plus the orders reassigned away from the helper
+        accepts = lambda event: user_authenticated_id in (event["helper_id"], event["previous_helper_id"])
+    else:
+        accepts = lambda event: True
+
+    if not BROADCASTER.open_stream():
+        # Every stream holds a web thread: past the limit the API would starve
+        response = jsonify({"message": "Too many open event streams, retry later"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SSE_BUSY_RETRY_SECONDS)
+        return response
+
+    # The stream runs after the app context, and its database session, are torn down
+    response = Response(stream_order_events(accepts, get_jwt().get('exp')), mimetype='text/event-stream')
+    # Released when the server closes the response, even if the stream never started
+    response.call_on_close(BROADCASTER.close_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/orders/changes', methods=['GET'])
+@jwt_required()
+@use_replica
+def order_changes():
+    """Orders changed since the client's cursor, once each, with their current data or
+    as removed when the user no longer sees them in GET /orders. Without ?since= it
+    only returns the current cursor: take it before loading GET /orders"""
+    user_authenticated_id = get_jwt_identity()
+    role_id = get_authenticated_role_id()
+    query = db.session.query(OrderChange.order_id, OrderChange.txid, OrderChange.id)
+    if role_id == Role.HELPER_ROLE_ID:
+        query = query.filter(OrderChange.helper_id == user_authenticated_id)
+    horizon = OrderChange.horizon()
+
+    since = request.args.get('since')
+    if not since:
+        if horizon is None:
+            cursor = [0, query.with_entities(db.func.max(OrderChange.id)).scalar() or 0]
+        else:
+            # Changes from the horizon on may be in GET /orders already: sent again at worst
+            cursor = [horizon, 0]
+        return jsonify({"changes": [], "cursor": encode_cursor(cursor), "has_more": False}), 200
+
+    txid, change_id = decode_cursor(since, int, int)
+    limit = get_page_limit(request.args, MAX_PAGE_SIZE)
+    # In commit order: a change that commits after a later id is still ahead of the cursor
+    query = query.filter(db.tuple_(OrderChange.txid, OrderChange.id) > db.tuple_(txid, change_id))
+    if horizon is not None:
+        query = query.filter(OrderChange.txid < horizon)
+    changed = query.order_by(OrderChange.txid, OrderChange.id).limit(limit + 1).all()
+    has_more = len(changed) > limit
+    changed = changed[:limit]
+
+    # Once each, with its current data, however many times it changed
+    order_ids = list(dict.fromkeys(change.order_id for change in changed))
+    orders = {order.id: order for order in Order.query.options(joinedload(Order.helper)).filter(Order.id.in_(order_ids))} if order_ids else {}
+    changes = []
+    for order_id in order_ids:
+        order = orders.get(order_id)
+        visible = order is not None and order.active
+        if visible and role_id == Role.HELPER_ROLE_ID:
+            visible = order.helper_id == user_authenticated_id and order.status_id != Status.REJECTED_STATUS_ID
+        changes.append({"id": order_id, "order": order.serialize()} if visible else {"id": order_id, "removed": True})
+
+    cursor = encode_cursor([changed[-1].txid, changed[-1].id]) if changed else since
+    return jsonify({"changes": changes, "cursor": cursor, "has_more": has_more}), 200
+
+@app.route('/orders/stats', methods=['GET'])
+@jwt_required()
+@use_replica
+@conditional_on('order', 'user', 'status')
+def order_stats():
+    """Active orders per status and per helper, and the average time orders spend in
+    each status, from the incrementally maintained summary tables"""
+    user_authenticated_id = get_jwt_identity()
+    query = db.session.query(OrderStat.status_id, OrderStat.helper_id, OrderStat.orders).filter(OrderStat.orders != 0)
+    if get_authenticated_role_id() == Role.HELPER_ROLE_ID:
+        query = query.filter(OrderStat.helper_id == user_authenticated_id)
+
+    by_status, by_helper = {}, {}
+    for status_id, helper_id, orders in query:
+        by_status[status_id] = by_status.get(status_id, 0) + orders
+        helper = by_helper.setdefault(helper_id, {"helper_id": helper_id, "orders": 0, "by_status": {}})
+        helper["orders"] += orders
+        helper["by_status"][status_id] = orders
+    helpers = {user.id: user for user in User.query.filter(User.id.in_(list(by_helper)))} if by_helper else {}
+    for helper_id, helper in by_helper.items():
+        helper["full_name"] = helpers[helper_id].full_name if helper_id in helpers else None
+    times = {row.status_id: row for row in OrderStatusTime.query}
+
+    statuses = []
+    for status in STATUSES.all():
+        time_in_status = times.get(status["id"])
+        statuses.append({
+            "status": status,
+            "orders": by_status.get(status["id"], 0),
+            "average_seconds": round(time_in_status.total_seconds / time_in_status.transitions, 1) if time_in_status and time_in_status.transitions else None,
+        })
+    return jsonify({
+        "total": sum(by_status.values()),
+        "by_status": statuses,
+        "by_helper": sorted(by_helper.values(), key=lambda helper: helper["helper_id"]),
+    }), 200
 
 @app.route('/orders', methods=['POST'])
 @jwt_required()
@@ -177,6 +498,9 @@ def create_order():
   
     order = Order(description=description, long_description=long_description, helper_id=helper_id, status_id=1)
     order.save()
+    # The order id is needed by the notification, which is queued in this same transaction
+    DBManager.flushSession()
+    new_order_mail(order.helper,order)
 
     documentURL = request.form.get('files')
     if documentURL:
@@ -188,8 +512,6 @@ def create_order():
     DBManager.commitSession()
 
     orderSerialized = order.serialize()
-    if orderSerialized:
-        new_order_mail(order.helper,order)
     # Añadir los documentos al objeto
     orderSerialized["documents"] = list(map(lambda document: document.serialize(), order.documents))
     return jsonify({"status": "ok", "order": orderSerialized})
@@ -197,8 +519,14 @@ def create_order():
 
 @app.route('/orders/<int:id>', methods=['GET'])
 @jwt_required()
+@conditional_on('order', 'user', 'role', 'status', 'document', 'address')
 def get_order(id):
     order = Order.query.get(id)   
+    if order is None:
+        # Cold orders are moved to the archive by flask archive-orders
+        order = ArchivedOrder.query.get(id)
+    if order is None:
+        raise APIException('Order not found', status_code=404)
     return jsonify(order.serializeForEditView()), 200
 
 @app.route('/orders/<int:id>', methods=['DELETE'])
@@ -208,7 +536,7 @@ def delete_order(id):
     if order is None:
         raise APIException('Order not found', status_code=404)
     order.active = False
-    print("ORDER ACTIVE",order.active)
+    order.save()
     DBManager.commitSession()
     
     return jsonify(order.serializeForEditView()), 200
@@ -250,8 +578,8 @@ def reject_order(id):
     order = Order.query.get(id)
     order.status_id = Status.REJECTED_STATUS_ID
     order.save()
-    response = DBManager.commitSession()
     order_rejection_mail(order)
+    response = DBManager.commitSession()
 
     return jsonify(order.serializeForEditView()), 200
 
@@ -261,8 +589,8 @@ def set_order_ready(id):
     order = Order.query.get(id)
     order.status_id = Status.READY_STATUS_ID
     order.save()
-    DBManager.commitSession()
     order_status_update_mail(order)
+    DBManager.commitSession()
     return jsonify(order.serializeForEditView()), 200
 
 @app.route('/orders/<int:id>/set-approved', methods=['POST'])
@@ -271,10 +599,53 @@ def set_order_approved(id):
     order = Order.query.get(id)
     order.status_id = Status.APPROVED_STATUS_ID
     order.save()
-    DBManager.commitSession()
     order_status_update_mail(order)
+    DBManager.commitSession()
     return jsonify(order.serializeForEditView()), 200
 
+BULK_STATUS_IDS = (Status.READY_STATUS_ID, Status.APPROVED_STATUS_ID)
+BULK_MAX_ORDERS = 500
+
+@app.route('/orders/bulk/status', methods=['POST'])
+@jwt_required()
+def set_orders_status():
+    order_ids = request.json.get('order_ids', None)
+    status_id = request.json.get('status_id', None)
+    if status_id not in BULK_STATUS_IDS:
+        raise APIException('status_id must be Ready or Approved', status_code=400)
+    if not isinstance(order_ids, list) or not order_ids or not all(isinstance(order_id, int) for order_id in order_ids):
+        raise APIException('order_ids must be a list of ids', status_code=400)
+    if len(order_ids) > BULK_MAX_ORDERS:
+        raise APIException(f'At most {BULK_MAX_ORDERS} orders per request', status_code=400)
+
+    order_ids = list(dict.fromkeys(order_ids))
+    # Lock the rows so the UPDATE changes exactly the orders reported as updated. Orders
+    # first, then the stats and versions, like the flush of a single order does
+    found = {order_id: order for order_id, order in locked_orders(db.session, order_ids).items() if order.active}
+    changed_ids = [order_id for order_id in order_ids if order_id in found and found[order_id].status_id != status_id]
+    if changed_ids:
+        # The bulk UPDATE skips the flush, so the stats are moved here
+        now = datetime.datetime.utcnow()
+        counts, durations = {}, {}
+        for order_id in changed_ids:
+            order = found[order_id]
+            counts[(order.status_id, order.helper_id)] = counts.get((order.status_id, order.helper_id), 0) - 1
+            counts[(status_id, order.helper_id)] = counts.get((status_id, order.helper_id), 0) + 1
+            if order.status_changed_at is not None:
+                durations.setdefault(order.status_id, []).append((now - order.status_changed_at).total_seconds())
+        Order.query.filter(Order.id.in_(changed_ids)).update({Order.status_id: status_id, Order.status_changed_at: now}, synchronize_session=False)
+        OrderStat.add(counts)
+        OrderStatusTime.add(durations)
+        TableVersion.bump(['order'])
+        # Orders already in the status didn't change: no event, change row or mail for them
+        queue_order_events(db.session, [order_event(STATUS_EVENTS[status_id], order_id, found[order_id].helper_id, status_id) for order_id in changed_ids])
+        OrderChange.record([(order_id, found[order_id].helper_id) for order_id in changed_ids])
+        orders_status_update_mail(changed_ids, status_id)
+    DBManager.commitSession()
+
+    results = [{"id": order_id, "status": "updated" if order_id in found else "not_found"} for order_id in order_ids]
+    return jsonify({"status_id": status_id, "results": results}), 200
+
 @app.route('/orders/<int:id>/save-video', methods=['POST'])
 @jwt_required()
 def save_video(id):
@@ -282,27 +653,85 @@ def save_video(id):
     order = Order.query.get(id)
 
     if os.environ.get('AWS_S3_BUCKET_NAME'):
-        files = request.files
-        print("files", files)
-        for key in files:
-
-            file = files[key]
-
-            if file:
-                url_document = upload_file_to_s3(file, os.environ.get('AWS_S3_BUCKET_NAME'))
-
-                if url_document:
-                    document = Document(name=file.filename, url=url_document, order=order, user_id=user_authenticated_id)
-                    document.save()
+        files = [file for file in request.files.values() if file]
+        for file, url_document, progress in upload_files_to_s3(files, os.environ.get('AWS_S3_BUCKET_NAME')):
+            if url_document:
+                document = Document(name=file.filename, url=url_document, order=order, user_id=user_authenticated_id, sha256=progress.sha256, size=progress.size)
+                document.save()
     else:
         print("Faltan las credenciales de AWS")
 
 
-    DBManager.commitSession()
     order_new_data_mail(order)
+    DBManager.commitSession()
 
     return jsonify(order.serializeForEditView()), 200
 
+@app.route('/orders/<int:id>/uploads', methods=['POST'])
+@jwt_required()
+def create_order_upload(id):
+    order = Order.query.get(id)
+    if order is None:
+        raise APIException('Order not found', status_code=404)
+    bucket_name = os.environ.get('AWS_S3_BUCKET_NAME')
+    if not bucket_name:
+        raise APIException('Uploads are not configured', status_code=503)
+
+    filename = request.json.get('filename', None)
+    content_type = request.json.get('content_type', None)
+    size = request.json.get('size', None)
+    if not isinstance(filename, str) or not filename or not isinstance(content_type, str) or not content_type or not isinstance(size, int) or isinstance(size, bool):
+        raise APIException('filename, content_type and size are required', status_code=400)
+    if not is_allowed_content_type(content_type):
+        raise APIException('Content type not allowed', status_code=400)
+    if size < 1 or size > AWS_S3_MAX_UPLOAD_MB * 1024 * 1024:
+        raise APIException(f'Files must be smaller than {AWS_S3_MAX_UPLOAD_MB} MB', status_code=400)
+
+    key = build_upload_key(f'orders/{order.id}', filename)
+    if len(filename) > Document.name.type.length or len(get_s3_location(bucket_name) + key) > Document.url.type.length:
+        raise APIException('filename is too long', status_code=400)
+    upload = create_presigned_upload(bucket_name, key, content_type, size)
+    if upload is None:
+        raise APIException('Upload could not be prepared', status_code=502)
+
+    return jsonify({"key": key, "url": upload["url"], "fields": upload["fields"]}), 201
+
+@app.route('/orders/<int:id>/uploads/finalize', methods=['POST'])
+@jwt_required()
+def finalize_order_upload(id):
+    user_authenticated_id = get_jwt_identity()
+    # Locked so two finalize requests for the same upload can't both create the document
+    order = Order.query.with_for_update().get(id)
+    if order is None:
+        raise APIException('Order not found', status_code=404)
+    bucket_name = os.environ.get('AWS_S3_BUCKET_NAME')
+    if not bucket_name:
+        raise APIException('Uploads are not configured', status_code=503)
+
+    key = request.json.get('key', None)
+    filename = request.json.get('filename', None)
+    if not isinstance(key, str) or not key.startswith(f'orders/{order.id}/'):
+        raise APIException('Invalid upload key', status_code=400)
+    if filename is not None and not isinstance(filename, str):
+        raise APIException('Invalid filename', status_code=400)
+    name = filename or key.rsplit('/', 1)[-1]
+    url = get_s3_location(bucket_name) + key
+    if len(name) > Document.name.type.length or len(url) > Document.url.type.length:
+        raise APIException('filename or key is too long', status_code=400)
+    if db.session.query(Document.query.filter(Document.order_id == order.id, Document.url == url).exists()).scalar():
+        raise APIException('Upload already finalized', status_code=409)
+    uploaded = get_uploaded_object(bucket_name, key)
+    if uploaded is None:
+        raise APIException('Upload not found', status_code=404)
+
+    # The client sent the file straight to S3, only its size is known here
+    document = Document(name=name, url=url, order=order, user_id=user_authenticated_id, size=uploaded.get('ContentLength'))
+    document.save()
+    order_new_data_mail(order)
+    DBManager.commitSession()
+
+    return jsonify(order.serializeForEditView()), 201
+
 @app.route('/orders/<int:id>/save-files', methods=['POST'])
 @jwt_required()
 def save_order_files(id):
@@ -314,9 +743,8 @@ def save_order_files(id):
     document = Document(name=filename, url=body['files'], order=order, user_id=user_authenticated_id)
     
     document.save()    
-    DBManager.commitSession()
-
     order_new_data_mail(order)
+    DBManager.commitSession()
 
     return jsonify(order.serializeForEditView()), 201
 
@@ -339,11 +767,9 @@ def save_order_addresses(id):
 
     order.status_id = Status.COMPLETED_STATUS_ID
     order.save()
-    response = DBManager.commitSession()
     order_rejection_mail(order)
-    
-
     order_new_data_mail(order)
+    response = DBManager.commitSession()
 
     return jsonify(order.serializeForEditView()), 200
 
@@ -357,10 +783,63 @@ def delete_document(id):
 
 @app.route('/helpers', methods=['GET'])
 @jwt_required()
+@use_replica
+@conditional_on('user', 'role')
 def helpers():
-    helpers = User.query.filter_by(role_id=Role.HELPER_ROLE_ID).all()
+    query = User.query.filter_by(role_id=Role.HELPER_ROLE_ID)
+    helpers, next_cursor = paginate_users(query)
     helpersJson = list(map(lambda helper: helper.serialize(), helpers))
-    return jsonify(helpersJson), 200
+    return paginated_response(helpersJson, next_cursor), 200
+
+# Workload that counts against a helper, and how much a 100% rejection rate weighs
+# against them, in open orders
+RECOMMENDATION_OPEN_STATUS_IDS = (Status.PENDING_STATUS_ID, Status.PROCESSING_STATUS_ID)
+RECOMMENDATION_REJECTION_WEIGHT = float(os.environ.get('RECOMMENDATION_REJECTION_WEIGHT', 5))
+RECOMMENDATION_DAYS = int(os.environ.get('RECOMMENDATION_DAYS', 30))
+
+def recommendation_window_start():
+    # Whole days, so the window, and the ETag with it, only moves at midnight UTC
+    return datetime.datetime.combine(datetime.datetime.utcnow().date() - datetime.timedelta(days=RECOMMENDATION_DAYS), datetime.time())
+
+@app.route('/helpers/recommended', methods=['GET'])
+@jwt_required()
+@use_replica
+@conditional_on('order', 'user', 'role', vary_on=lambda: recommendation_window_start().isoformat())
+def recommended_helpers():
+    """Active helpers, least loaded first: open orders from the order_stat summary plus
+    the share of their recent orders they rejected, in one query"""
+    open_orders = db.session.query(OrderStat.helper_id, db.func.sum(OrderStat.orders).label('orders')).filter(
+        OrderStat.status_id.in_(RECOMMENDATION_OPEN_STATUS_IDS)
+    ).group_by(OrderStat.helper_id).subquery()
+    since = recommendation_window_start()
+    recent_orders = db.session.query(
+        Order.helper_id,
+        db.func.count().label('orders'),
+        db.func.sum(db.case([(Order.status_id == Status.REJECTED_STATUS_ID, 1)], else_=0)).label('rejected'),
+    ).filter(Order.active == True, Order.created_at >= since).group_by(Order.helper_id).subquery()
+
+    open_count = db.func.coalesce(open_orders.c.orders, 0)
+    recent_count = db.func.coalesce(recent_orders.c.orders, 0)
+    rejected_count = db.func.coalesce(recent_orders.c.rejected, 0)
+    rejection_rate = db.case([(recent_count > 0, rejected_count * 1.0 / recent_count)], else_=0.0)
+    score = open_count + rejection_rate * RECOMMENDATION_REJECTION_WEIGHT
+    query = db.session.query(User, open_count, recent_count, rejected_count, rejection_rate, score).outerjoin(
+        open_orders, open_orders.c.helper_id == User.id
+    ).outerjoin(
+        recent_orders, recent_orders.c.helper_id == User.id
+    ).filter(User.role_id == Role.HELPER_ROLE_ID, User.is_active == True).order_by(score, User.id)
+
+    recommendations = []
+    for helper, open_total, recent_total, rejected_total, rate, helper_score in query.limit(get_page_limit(request.args, 10)):
+        recommendations.append({
+            "helper": helper.serialize(),
+            "open_orders": int(open_total),
+            "recent_orders": int(recent_total),
+            "recent_rejections": int(rejected_total),
+            "rejection_rate": round(float(rate), 3),
+            "score": round(float(helper_score), 3),
+        })
+    return jsonify(recommendations), 200
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -380,7 +859,7 @@ def login():
     # access_token = create_access_token(identity=user.id)
 
     if check_password_hash(user.password, password): 
-        access_token = create_access_token(identity=user.id)
+        access_token = create_access_token(identity=user.id, additional_claims={"role_id": user.role_id})
     else:
         return jsonify({"status": 'ko', "msg": "Bad username or password"}), 401
 
@@ -0,0 +1,116 @@
+"""
+Prometheus metrics with prometheus_client. When PROMETHEUS_MULTIPROC_DIR is set every
+process (gunicorn workers, the email worker) writes its samples to files in that
+directory and GET /metrics aggregates them, so any worker answers with the totals.
+gunicorn.conf.py empties the directory when the server starts and drops the gauges of
+the workers that exit. GET /metrics needs METRICS_TOKEN as a bearer token unless
+METRICS_PUBLIC=true
+"""
+import os
+import hmac
+import time
+from flask import g, request, Response
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UPLOAD_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+
+# Gauges add up the values of the live processes; counters and histograms keep those
+# of the dead ones too
+HTTP_REQUESTS = Counter('http_requests_total', 'Requests by method, route and status code', ['method', 'route', 'status'])
+HTTP_REQUEST_DURATION = Histogram('http_request_duration_seconds', 'Request latency by method and route', ['method', 'route'], buckets=LATENCY_BUCKETS)
+HTTP_REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'Requests being served right now', multiprocess_mode='livesum')
+DB_POOL_CHECKOUT = Histogram('db_pool_checkout_seconds', 'Time to get a connection from the SQLAlchemy pool, waiting for a free one included', ['pool'], buckets=LATENCY_BUCKETS)
+DB_POOL_SIZE = Gauge('db_pool_size', 'Connections the SQLAlchemy pools keep open', ['pool'], multiprocess_mode='livesum')
+DB_POOL_CONNECTIONS = Gauge('db_pool_connections', 'Connections open in the SQLAlchemy pools, overflow included', ['pool'], multiprocess_mode='livesum')
+DB_POOL_CHECKED_OUT = Gauge('db_pool_checked_out', 'Connections in use', ['pool'], multiprocess_mode='livesum')
+DB_POOL_TIMEOUTS = Counter('db_pool_timeouts_total', 'Checkouts that gave up waiting for a free connection', ['pool'])
+SENDGRID_REQUEST_DURATION = Histogram('sendgrid_request_seconds', 'SendGrid API call latency', buckets=LATENCY_BUCKETS)
+SENDGRID_FAILURES = Counter('sendgrid_failures_total', 'SendGrid API calls that failed')
+S3_UPLOAD_BYTES = Counter('s3_upload_bytes_total', 'Bytes uploaded to S3')
+S3_UPLOAD_DURATION = Histogram('s3_upload_seconds', 'Duration of each S3 file upload', buckets=UPLOAD_BUCKETS)
+S3_UPLOAD_DEDUPLICATED = Counter('s3_upload_deduplicated_total', 'Uploads skipped because the bucket already had the content')
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that times every connect(), the wait for a free connection included,
+    and records how many connections are open and in use, labelled with the pool's
+    logging name. Only public pool API: connect(), the connection's info and the
+    checkin event"""
+
+    def __init__(self, creator, logging_name=None, **kwargs):
+        super().__init__(creator, logging_name=logging_name, **kwargs)
+        self.metrics_labels = {"pool": logging_name or 'default'}
+
+    def connect(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.labels(**self.metrics_labels).inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT.labels(**self.metrics_labels).observe(time.perf_counter() - started_at)
+        # Lets the checkin event find the pool the connection goes back to
+        connection.info['metrics_pool'] = self
+        self.record_usage()
+        return connection
+
+    def record_usage(self):
+        DB_POOL_SIZE.labels(**self.metrics_labels).set(self.size())
+        # overflow() starts at -size and grows with every connection opened
+        DB_POOL_CONNECTIONS.labels(**self.metrics_labels).set(self.size() + self.overflow())
+        DB_POOL_CHECKED_OUT.labels(**self.metrics_labels).set(self.checkedout())
+
+@event.listens_for(InstrumentedQueuePool, 'checkin')
+def record_pool_checkin(dbapi_connection, connection_record):
+    pool = connection_record.info.get('metrics_pool')
+    if pool is not None:
+        pool.record_usage()
+
+def start_request_metrics():
+    g.metrics_started_at = time.perf_counter()
+    HTTP_REQUESTS_IN_FLIGHT.inc()
+
+def record_request_metrics(response):
+    started_at = g.get('metrics_started_at')
+    if started_at is not None:
+        # The route template, not the path, keeps one series per endpoint
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUESTS.labels(method=request.method, route=route, status=response.status_code).inc()
+        HTTP_REQUEST_DURATION.labels(method=request.method, route=route).observe(time.perf_counter() - started_at)
+    return response
+
+def finish_request_metrics(exception=None):
+    if g.pop('metrics_started_at', None) is not None:
+        HTTP_REQUESTS_IN_FLIGHT.dec()
+
+def collect():
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return generate_latest(REGISTRY)
+    # A registry per scrape that reads every process' files
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+def is_authorized():
+    if os.environ.get('METRICS_PUBLIC', 'false').lower() == 'true':
+        return True
+    token = os.environ.get('METRICS_TOKEN')
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+def metrics_view():
+    if not is_authorized():
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(collect(), mimetype=CONTENT_TYPE_LATEST)
+
+def init_metrics(app):
+    app.before_request(start_request_metrics)
+    app.after_request(record_request_metrics)
+    app.teardown_request(finish_request_metrics)
+    app.add_url_rule('/metrics', 'metrics', metrics_view, methods=['GET'])
@@ -1,21 +1,211 @@
-from flask_sqlalchemy import SQLAlchemy
+import os
+import re
+import time
+import operator
+import datetime
+import threading
+from flask import current_app, g, has_request_context, session as cookie_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import DDL, event, inspect, orm
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session
 from sqlalchemy.sql import func
+from jsonprovider import format_datetime
 
-db = SQLAlchemy()
+REPLICA_BIND = 'replica'
+# How often each process checks whether Role or Status changed
+LOOKUP_TABLES_REFRESH_SECONDS = float(os.environ.get('LOOKUP_TABLES_REFRESH_SECONDS', 5))
+
+def replica_enabled(app=None):
+    app = app or current_app
+    return REPLICA_BIND in (app.config.get('SQLALCHEMY_BINDS') or {})
+
+class RoutingSession(SignallingSession):
+    """Sends the queries of the views marked to use the replica there. Flushes, and
+    so every INSERT/UPDATE/DELETE, always go to the primary"""
+
+    # scoped_session passes every argument of Session.get_bind positionally
+    def get_bind(self, mapper=None, clause=None, bind=None, *args, **kwargs):
+        if bind is not None:
+            return bind
+        if not self._flushing and has_request_context() and g.get('use_replica'):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        # SignallingSession.get_bind only takes the mapper and the clause
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # Tells the primary's pool from the replica's in the logs and in /metrics
+        is_primary = sa_url == make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        options['pool_logging_name'] = 'primary' if is_primary else REPLICA_BIND
+        return super().apply_driver_hacks(app, sa_url, options)
+
+db = RoutingSQLAlchemy()
 
 class DBManager():
 
     @staticmethod
     def commitSession():
+        if has_request_context() and replica_enabled():
+            # From here on this request, and the user's next ones, read the primary
+            g.use_replica = False
+            record_write(current_user_id())
         db.session.commit()
 
+    @staticmethod
+    def flushSession():
+        db.session.flush()
+
+def current_user_id():
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        # Not a @jwt_required view (login, password reset...)
+        return None
+
+def record_write(user_id):
+    """Remembers the user's last write in Flask's session cookie, signed with the
+    secret key, so the next requests know it without querying the primary"""
+    if user_id is not None:
+        cookie_session['last_write'] = [user_id, time.time()]
+
+def wrote_recently(user_id, seconds):
+    """Whether the request's session cookie says the user wrote in the last seconds"""
+    if user_id is None or seconds <= 0:
+        return False
+    last_write = cookie_session.get('last_write')
+    # A cookie left by another user of the same browser doesn't count
+    return bool(last_write) and last_write[0] == user_id and time.time() - last_write[1] < seconds
+
+def column_serializer(model, fields):
+    """Builds, once, a function returning the given columns of the model as a dict.
+    Dates are formatted in place so the JSON encoder never has to inspect the values"""
+    columns = model.__table__.columns
+    dates = tuple(field for field in fields if isinstance(columns[field].type, (db.DateTime, db.Date)))
+    plain = tuple(field for field in fields if field not in dates)
+    get_plain = operator.attrgetter(*plain)
+    if len(plain) == 1:
+        get_plain = lambda obj, get=get_plain: (get(obj),)
+    get_dates = [(field, operator.attrgetter(field)) for field in dates]
+
+    def serialize(obj):
+        values = dict(zip(plain, get_plain(obj)))
+        for field, get in get_dates:
+            values[field] = format_datetime(get(obj))
+        return values
+    return serialize
+
 class ModelHelper():
+    # Columns returned by serialize_columns(). A new column stays out of the API
+    # responses until it's added here
+    serialize_fields = ()
+
+    @classmethod
+    def get_column_serializer(cls):
+        serializer = cls.__dict__.get('_column_serializer')
+        if serializer is None:
+            serializer = column_serializer(cls, cls.serialize_fields)
+            cls._column_serializer = serializer
+        return serializer
+
+    def serialize_columns(self):
+        return self.get_column_serializer()(self)
 
     def save(self):
         db.session.add(self)
+        OrderChange.track(self.changed_orders())
 
     def delete(self):
         db.session.delete(self)
+        OrderChange.track(self.changed_orders())
+
+    def changed_orders(self):
+        """Orders whose representation changes when this object is saved or deleted"""
+        return ()
+
+class LookupTableCache():
+    """Process-local copy of a static lookup table (Role, Status), serialized by id.
+    Reloaded when the table's TableVersion changes, which every process checks at most
+    every refresh_seconds, so a seed command run elsewhere reaches the web workers"""
+
+    def __init__(self, model, refresh_seconds=None):
+        self.model = model
+        self.refresh_seconds = LOOKUP_TABLES_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
+        self._items = None
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._items is None or time.monotonic() - self._checked_at > self.refresh_seconds:
+                table = self.model.__tablename__
+                version = TableVersion.get_versions([table])[table]
+                if self._items is None or version != self._version:
+                    self._items = {item.id: item.serialize() for item in self.model.query.order_by(self.model.id).all()}
+                    self._version = version
+                self._checked_at = time.monotonic()
+            return self._items
+
+    def _current(self):
+        items = self._items
+        if items is not None and time.monotonic() - self._checked_at <= self.refresh_seconds:
+            return items
+        return self._load()
+
+    def all(self):
+        return list(self._current().values())
+
+    def get(self, id):
+        items = self._current()
+        if id not in items and id is not None:
+            # The table may have been seeded after the first load
+            self.invalidate()
+            items = self._load()
+        return items.get(id)
+
+    def invalidate(self):
+        with self._lock:
+            self._items = None
+
+class UserAccessCache():
+    """Role of every active user, reloaded when the user TableVersion changes, which every
+    process checks at most every refresh_seconds. Lets the JWT check reject the tokens of
+    deactivated users, and those issued before a role change, without a query per request"""
+
+    def __init__(self, refresh_seconds):
+        self.refresh_seconds = refresh_seconds
+        self._roles = None
+        self._version = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._roles is None or time.monotonic() - self._checked_at > self.refresh_seconds:
+                version = TableVersion.get_versions(['user'])['user']
+                if self._roles is None or version != self._version:
+                    self._roles = dict(db.session.query(User.id, User.role_id).filter(User.is_active == True))
+                    self._version = version
+                self._checked_at = time.monotonic()
+            return self._roles
+
+    def is_revoked(self, user_id, claims):
+        roles = self._load()
+        if user_id not in roles:
+            return True
+        # Tokens issued before the role was added to the claims carry none
+        return 'role_id' in claims and claims['role_id'] != roles[user_id]
+
+    def invalidate(self):
+        with self._lock:
+            self._roles = None
 
 class User(db.Model, ModelHelper):
     id = db.Column(db.Integer, primary_key=True)
@@ -33,29 +223,36 @@ class User(db.Model, ModelHelper):
     orders = db.relationship("Order", back_populates="helper", lazy=True)
     documents = db.relationship("Document", back_populates="user", lazy=True)
     addresses = db.relationship("Address", back_populates="user", lazy=True)
+
+    # Índices ajustados a los filtros de /users, /helpers y /reset-password
+    __table_args__ = (
+        db.Index('ix_user_role_id_id', 'role_id', 'id'),
+        db.Index('ix_user_active_id', 'id', postgresql_where=db.text('is_active = true'), sqlite_where=db.text('is_active = 1')),
+        db.Index('ix_user_reset_password_token', 'reset_password_token', postgresql_where=db.text('reset_password_token IS NOT NULL'), sqlite_where=db.text('reset_password_token IS NOT NULL')),
+    )
     
     def __repr__(self):
         return '<User %r>' % self.full_name
 
+    serialize_fields = ('id', 'email', 'full_name', 'phone', 'role_id')
+
     def serialize(self):
-        return {
-            "id": self.id,
-            "email": self.email,
-            "full_name": self.full_name,
-            "phone": self.phone,
-            "role_id": self.role_id,
-            "role": self.role.serialize()
-        }
+        user = self.serialize_columns()
+        user["role"] = ROLES.get(self.role_id)
+        return user
 
 class Order(db.Model, ModelHelper): 
     id = db.Column(db.Integer, primary_key=True) 
     description = db.Column(db.String(120), unique=False, nullable=False)
     long_description = db.Column(db.String(5000), unique=False, nullable=True)
-    active = db.Column(db.Boolean, unique=False, default=True)  
+    # active_history: order_stat needs the previous value even if the order was
+    # expired by a commit before the change
+    active = orm.column_property(db.Column(db.Boolean, unique=False, default=True), active_history=True)
     created_at = db.Column(db.DateTime, server_default=func.now()) 
+    status_changed_at = db.Column(db.DateTime, server_default=func.now())
     # Claves Foráneas:
-    helper_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=False, nullable=False)
-    status_id = db.Column(db.Integer, db.ForeignKey('status.id'), unique=False, nullable=False)
+    helper_id = orm.column_property(db.Column(db.Integer, db.ForeignKey('user.id'), unique=False, nullable=False), active_history=True)
+    status_id = orm.column_property(db.Column(db.Integer, db.ForeignKey('status.id'), unique=False, nullable=False), active_history=True)
     address_delivery_id = db.Column(db.Integer, db.ForeignKey('address.id'), unique=False)
     address_pickup_id = db.Column(db.Integer, db.ForeignKey('address.id'), unique=False)
     # Relaciones bidireccionales:
@@ -67,20 +264,28 @@ class Order(db.Model, ModelHelper):
     #many
     documents = db.relationship("Document", back_populates="order", lazy=True)
 
+    # Índices parciales sobre pedidos activos, en el mismo orden que el listado de /orders
+    __table_args__ = (
+        db.Index('ix_order_active_created_at_id', 'created_at', 'id', postgresql_where=db.text('active = true'), sqlite_where=db.text('active = 1')),
+        db.Index('ix_order_active_helper_id_created_at_id', 'helper_id', 'created_at', 'id', postgresql_where=db.text('active = true'), sqlite_where=db.text('active = 1')),
+        db.Index('ix_order_active_status_id_created_at_id', 'status_id', 'created_at', 'id', postgresql_where=db.text('active = true'), sqlite_where=db.text('active = 1')),
+        # Pedidos fríos que flask archive-orders mueve al archivo
+        db.Index('ix_order_cold_status_changed_at', 'status_changed_at', postgresql_where=db.text('active = false OR status_id = 6'), sqlite_where=db.text('active = 0 OR status_id = 6')),
+    )
+
     def __repr__(self):
         return '<Order %r>' % self.id
 
+    def changed_orders(self):
+        return (self,)
+
+    serialize_fields = ('id', 'helper_id', 'status_id', 'description', 'long_description', 'created_at')
+
     def serialize(self):
-        return {
-            "id": self.id,
-            "helper_id": self.helper_id,
-            "helper": self.helper.serialize(),
-            "status": self.status.serialize(),
-            "status_id": self.status_id,
-            "description": self.description,
-            "long_description": self.long_description,
-            "created_at": self.created_at
-        }
+        order = self.serialize_columns()
+        order["helper"] = self.helper.serialize()
+        order["status"] = STATUSES.get(self.status_id)
+        return order
 
     def serializeForEditView(self):
         order = self.serialize()
@@ -91,6 +296,56 @@ class Order(db.Model, ModelHelper):
             order["address_pickup"] = self.address_pickup.serialize()
         return order
 
+# Búsqueda de texto sobre description y long_description, fuera del modelo porque
+# depende de la base de datos: en Postgres una columna tsvector generada con índice
+# GIN, en SQLite una tabla FTS5 mantenida con triggers
+ORDER_SEARCH_CONFIG = 'spanish'
+ORDER_SEARCH_VECTOR = (
+    f"setweight(to_tsvector('{ORDER_SEARCH_CONFIG}', coalesce(description, '')), 'A') || "
+    f"setweight(to_tsvector('{ORDER_SEARCH_CONFIG}', coalesce(long_description, '')), 'B')"
+)
+ORDER_SEARCH_DDL = {
+    'postgresql': [
+        f'ALTER TABLE "order" ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ({ORDER_SEARCH_VECTOR}) STORED',
+        'CREATE INDEX ix_order_search_vector ON "order" USING gin (search_vector)',
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS order_search USING fts5(description, long_description, content='order', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        'CREATE TRIGGER IF NOT EXISTS order_search_insert AFTER INSERT ON "order" BEGIN '
+        'INSERT INTO order_search (rowid, description, long_description) VALUES (new.id, new.description, new.long_description); END',
+        'CREATE TRIGGER IF NOT EXISTS order_search_delete AFTER DELETE ON "order" BEGIN '
+        "INSERT INTO order_search (order_search, rowid, description, long_description) VALUES ('delete', old.id, old.description, old.long_description); END",
+        'CREATE TRIGGER IF NOT EXISTS order_search_update AFTER UPDATE OF description, long_description ON "order" BEGIN '
+        "INSERT INTO order_search (order_search, rowid, description, long_description) VALUES ('delete', old.id, old.description, old.long_description); "
+        'INSERT INTO order_search (rowid, description, long_description) VALUES (new.id, new.description, new.long_description); END',
+        # The table may survive a drop_all with stale rows
+        "INSERT INTO order_search (order_search) VALUES ('rebuild')",
+    ],
+}
+for dialect, statements in ORDER_SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Order.__table__, 'after_create', DDL(statement).execute_if(dialect=dialect))
+
+def search_terms(text):
+    # Only words reach the search syntax of either database
+    return re.findall(r'\w+', text or '')[:10]
+
+def match_orders(query, terms, dialect):
+    """Filters an Order query to the orders matching every term, as a prefix, and
+    orders it by relevance: description matches weigh more than long_description"""
+    if dialect == 'postgresql':
+        vector = db.literal_column('"order".search_vector')
+        tsquery = func.to_tsquery(ORDER_SEARCH_CONFIG, ' & '.join(f'{term}:*' for term in terms))
+        return query.filter(vector.op('@@')(tsquery)).order_by(func.ts_rank_cd(vector, tsquery).desc(), Order.created_at.desc(), Order.id.desc())
+    if dialect == 'sqlite':
+        fts = db.table('order_search', db.column('rowid'))
+        matches = db.select(fts.c.rowid.label('order_id'), func.bm25(db.literal_column('order_search'), 10.0, 1.0).label('rank')).select_from(fts).where(
+            db.literal_column('order_search').op('MATCH')(' '.join(f'"{term}"*' for term in terms))
+        ).subquery()
+        # bm25() is lower for better matches
+        return query.join(matches, matches.c.order_id == Order.id).order_by(matches.c.rank, Order.created_at.desc(), Order.id.desc())
+    raise ValueError(f'Order search is not supported on {dialect}')
+
 class Status(db.Model, ModelHelper): 
     id = db.Column(db.Integer, primary_key=True) 
     name = db.Column(db.String(80), unique=False, nullable=False)
@@ -107,11 +362,10 @@ class Status(db.Model, ModelHelper):
     def __repr__(self):
         return '<Status %s>' % self.name
 
+    serialize_fields = ('id', 'name')
+
     def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name        
-        }   
+        return self.serialize_columns()
 
 class Role(db.Model, ModelHelper): 
     id = db.Column(db.Integer, primary_key=True) 
@@ -126,18 +380,23 @@ class Role(db.Model, ModelHelper):
     def __repr__(self):
         return '<Role %r>' % self.name
 
+    serialize_fields = ('id', 'name')
+
     def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name        
-        }
+        return self.serialize_columns()
+
+ROLES = LookupTableCache(Role)
+STATUSES = LookupTableCache(Status)
 
 class Document(db.Model, ModelHelper): 
     id = db.Column(db.Integer, primary_key=True) 
     name = db.Column(db.String(250), unique=False, nullable=False) 
     url = db.Column(db.String(255), unique=False, nullable=False) 
+    # Contenido del fichero, cuando lo subió la API
+    sha256 = db.Column(db.String(64), unique=False, nullable=True)
+    size = db.Column(db.BigInteger, unique=False, nullable=True)
     # Claves Foráneas:
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), unique=False, nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), unique=False, nullable=False, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=False, nullable=False)
     # Relaciones bidireccionales:
     user = db.relationship("User", back_populates="documents", lazy=True)
@@ -146,13 +405,13 @@ class Document(db.Model, ModelHelper):
     def __repr__(self):
         return '<Document %r>' % self.id
 
+    def changed_orders(self):
+        return (self.order,) if self.order is not None else ()
+
+    serialize_fields = ('id', 'name', 'url', 'user_id')
+
     def serialize(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "url": self.url,
-            "user_id": self.user_id
-        }
+        return self.serialize_columns()
 
 class Address(db.Model, ModelHelper): 
     id = db.Column(db.Integer, primary_key=True)
@@ -170,11 +429,317 @@ class Address(db.Model, ModelHelper):
     def __repr__(self):
         return '<Address %r>' % self.id
 
+    serialize_fields = ('id', 'address', 'city', 'country', 'cp')
+
+    def serialize(self):
+        return self.serialize_columns()
+
+# Pedidos fríos (borrados o completados hace tiempo) movidos fuera de la tabla order
+# por flask archive-orders. Mismas columnas y mismos ids que en order
+class ArchivedOrder(db.Model, ModelHelper):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(120), unique=False, nullable=False)
+    long_description = db.Column(db.String(5000), unique=False, nullable=True)
+    active = db.Column(db.Boolean, unique=False, default=True)
+    created_at = db.Column(db.DateTime)
+    status_changed_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, server_default=func.now())
+    # Claves Foráneas:
+    helper_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=False, nullable=False)
+    status_id = db.Column(db.Integer, db.ForeignKey('status.id'), unique=False, nullable=False)
+    address_delivery_id = db.Column(db.Integer, db.ForeignKey('address.id'), unique=False)
+    address_pickup_id = db.Column(db.Integer, db.ForeignKey('address.id'), unique=False)
+    # Relaciones:
+    helper = db.relationship("User", lazy=True)
+    address_delivery = db.relationship("Address", foreign_keys=[address_delivery_id])
+    address_pickup = db.relationship("Address", foreign_keys=[address_pickup_id])
+    documents = db.relationship("ArchivedDocument", back_populates="order", lazy=True)
+
+    # El listado del archivo, por ayudante o completo, en orden de id
+    __table_args__ = (
+        db.Index('ix_archived_order_helper_id_id', 'helper_id', 'id'),
+    )
+
+    def __repr__(self):
+        return '<ArchivedOrder %r>' % self.id
+
+    serialize_fields = ('id', 'helper_id', 'status_id', 'description', 'long_description', 'created_at', 'archived_at')
+
     def serialize(self):
-        return {
-            "id": self.id,
-            "address": self.address,
-            "city": self.city,
-            "country": self.country,
-            "cp": self.cp,
-        }   
+        order = self.serialize_columns()
+        order["helper"] = self.helper.serialize()
+        order["status"] = STATUSES.get(self.status_id)
+        order["archived"] = True
+        return order
+
+    def serializeForEditView(self):
+        order = self.serialize()
+        order["documents"] = list(map(lambda document: document.serialize(), self.documents))
+        if self.address_delivery:
+            order["address_delivery"] = self.address_delivery.serialize()
+        if self.address_pickup:
+            order["address_pickup"] = self.address_pickup.serialize()
+        return order
+
+class ArchivedDocument(db.Model, ModelHelper):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(250), unique=False, nullable=False)
+    url = db.Column(db.String(255), unique=False, nullable=False)
+    sha256 = db.Column(db.String(64), unique=False, nullable=True)
+    size = db.Column(db.BigInteger, unique=False, nullable=True)
+    # Claves Foráneas:
+    order_id = db.Column(db.Integer, db.ForeignKey('archived_order.id'), unique=False, nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), unique=False, nullable=False)
+    # Relaciones:
+    order = db.relationship("ArchivedOrder", back_populates="documents", lazy=True)
+
+    def __repr__(self):
+        return '<ArchivedDocument %r>' % self.id
+
+    serialize_fields = ('id', 'name', 'url', 'user_id')
+
+    def serialize(self):
+        return self.serialize_columns()
+
+
+class OutboxEmail(db.Model, ModelHelper):
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(120), unique=False, nullable=False)
+    subject = db.Column(db.String(250), unique=False, nullable=False)
+    html_content = db.Column(db.Text, unique=False, nullable=False)
+    status = db.Column(db.String(20), unique=False, nullable=False, default='pending')
+    attempts = db.Column(db.Integer, unique=False, nullable=False, default=0)
+    last_error = db.Column(db.String(500), unique=False, nullable=True)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+    next_attempt_at = db.Column(db.DateTime, server_default=func.now())
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    PENDING_STATUS = 'pending'
+    SENT_STATUS = 'sent'
+    FAILED_STATUS = 'failed'
+
+    # El worker sólo lee los pendientes, por orden de reintento
+    __table_args__ = (
+        db.Index('ix_outbox_email_pending_next_attempt_at', 'next_attempt_at', postgresql_where=db.text("status = 'pending'"), sqlite_where=db.text("status = 'pending'")),
+    )
+
+    def __repr__(self):
+        return '<OutboxEmail %r>' % self.id
+
+    serialize_fields = ('id', 'to_email', 'subject', 'status', 'attempts', 'last_error', 'created_at', 'sent_at')
+
+    def serialize(self):
+        return self.serialize_columns()
+
+
+UPSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+def upsert_add(connection, table, keys, rows):
+    """Inserts the rows, or adds their values to those of the rows already there with the
+    same keys, in one INSERT ... ON CONFLICT DO UPDATE. Unlike an UPDATE followed by an
+    INSERT, two transactions creating the same row can't fail with a unique violation"""
+    if not rows:
+        return
+    statement = UPSERTS[connection.dialect.name](table).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=keys,
+        set_={name: table.c[name] + statement.excluded[name] for name in rows[0] if name not in keys}
+    )
+    connection.execute(statement)
+
+class TableVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, unique=False, nullable=False, default=0)
+
+    # Tablas cuyos cambios invalidan los ETag de los listados y del detalle de pedidos
+    VERSIONED_TABLES = ('user', 'order', 'document', 'address', 'role', 'status')
+
+    def __repr__(self):
+        return '<TableVersion %s=%r>' % (self.name, self.version)
+
+    @staticmethod
+    def bump(names, session=None):
+        """Also to be called after bulk UPDATE/DELETE statements, which skip the flush"""
+        # Straight on the connection so the UPDATE doesn't trigger another flush
+        connection = (session or db.session).connection()
+        upsert_add(connection, TableVersion.__table__, ['name'], [{"name": name, "version": 1} for name in sorted(names)])
+
+    @staticmethod
+    def get_versions(names):
+        rows = db.session.query(TableVersion.name, TableVersion.version).filter(TableVersion.name.in_(names))
+        versions = dict.fromkeys(names, 0)
+        versions.update(rows)
+        return versions
+
+# Registro de cambios de pedidos para GET /orders/changes. Cada fila dice que el
+# pedido cambió para los usuarios que lo ven a través de helper_id. Los ids se
+# reparten antes del commit, así que el orden de commit lo da txid, la transacción
+# que escribió la fila (0 en SQLite, donde las escrituras van una detrás de otra)
+class OrderChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, unique=False, nullable=False)
+    helper_id = db.Column(db.Integer, unique=False, nullable=False)
+    txid = db.Column(db.BigInteger, unique=False, nullable=False, server_default='0')
+    created_at = db.Column(db.DateTime, server_default=func.now())
+
+    # Lectura por ayudante y compactación por pedido, ambas en orden de (txid, id)
+    __table_args__ = (
+        db.Index('ix_order_change_helper_id_txid_id', 'helper_id', 'txid', 'id'),
+        db.Index('ix_order_change_order_id_helper_id_txid_id', 'order_id', 'helper_id', 'txid', 'id'),
+    )
+
+    def __repr__(self):
+        return '<OrderChange %r>' % self.id
+
+    @staticmethod
+    def track(orders):
+        """Marks the orders as changed; the rows are written after the next flush,
+        once new orders have an id"""
+        if orders:
+            db.session.info.setdefault('changed_orders', set()).update(orders)
+
+    @staticmethod
+    def record(rows, session=None):
+        """Writes (order_id, helper_id) rows. Also to be called after bulk UPDATE
+        statements, which skip ModelHelper.save"""
+        if rows:
+            connection = (session or db.session).connection()
+            txid = func.txid_current() if connection.dialect.name == 'postgresql' else 0
+            connection.execute(OrderChange.__table__.insert().values(txid=txid), [{"order_id": order_id, "helper_id": helper_id} for order_id, helper_id in rows])
+
+    @staticmethod
+    def horizon():
+        """Every transaction below it has finished: no row with a lower txid can commit
+        from now on, so the feed only hands out those. None on SQLite, where a row
+        can't commit after one with a higher id"""
+        if db.session.get_bind().dialect.name != 'postgresql':
+            return None
+        return db.session.query(func.txid_snapshot_xmin(func.txid_current_snapshot())).scalar()
+
+@event.listens_for(Session, 'after_flush')
+def record_order_changes(session, flush_context):
+    orders = session.info.pop('changed_orders', None)
+    if not orders:
+        return
+    rows = set()
+    for order in orders:
+        if order.id is None or order in session.deleted:
+            continue
+        # helper_id may come straight from the form, as a string
+        rows.add((order.id, int(order.helper_id)))
+        # A reassigned order also changes, it disappears, for its previous helper
+        history = inspect(order).attrs.helper_id.history
+        rows.update((order.id, int(helper_id)) for helper_id in history.deleted if helper_id is not None)
+    OrderChange.record(sorted(rows), session)
+
+@event.listens_for(Session, 'after_rollback')
+def forget_order_changes(session):
+    session.info.pop('changed_orders', None)
+
+# Pedidos activos por estado y ayudante, para GET /orders/stats sin recorrer los
+# pedidos. Se actualiza en la misma transacción que el pedido; flask
+# reconcile-order-stats corrige cualquier desviación
+class OrderStat(db.Model):
+    status_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    helper_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    orders = db.Column(db.Integer, unique=False, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<OrderStat %r/%r=%r>' % (self.status_id, self.helper_id, self.orders)
+
+    @staticmethod
+    def add(counts, session=None):
+        """Adds the {(status_id, helper_id): delta} counts. Also to be called after bulk
+        UPDATE statements, which skip the flush"""
+        connection = (session or db.session).connection()
+        # Always in the same order, so concurrent transactions don't deadlock
+        rows = [{"status_id": status_id, "helper_id": helper_id, "orders": delta} for (status_id, helper_id), delta in sorted(counts.items()) if delta != 0]
+        upsert_add(connection, OrderStat.__table__, ['status_id', 'helper_id'], rows)
+
+# Tiempo acumulado que los pedidos han pasado en cada estado, al salir de él
+class OrderStatusTime(db.Model):
+    status_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    total_seconds = db.Column(db.Float, unique=False, nullable=False, default=0)
+    transitions = db.Column(db.Integer, unique=False, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<OrderStatusTime %r>' % self.status_id
+
+    @staticmethod
+    def add(durations, session=None):
+        """Adds the {status_id: [seconds, ...]} spent by orders that left the status"""
+        connection = (session or db.session).connection()
+        rows = [{"status_id": status_id, "total_seconds": sum(seconds), "transitions": len(seconds)} for status_id, seconds in sorted(durations.items()) if seconds]
+        upsert_add(connection, OrderStatusTime.__table__, ['status_id'], rows)
+
+def locked_orders(session, order_ids):
+    """Locks the orders, in id order, and returns their committed columns by id. Every
+    transaction that changes orders locks them before the order_stat, order_status_time
+    and table_version rows, the bulk endpoint and the archive included, so they can't
+    deadlock each other. The values are read after the lock: the loaded ones may
+    predate another transaction's commit"""
+    if not order_ids:
+        return {}
+    table = Order.__table__
+    rows = session.connection().execute(
+        db.select(table.c.id, table.c.status_id, table.c.helper_id, table.c.active, table.c.status_changed_at)
+        .where(table.c.id.in_(order_ids)).order_by(table.c.id).with_for_update()
+    )
+    return {row.id: row for row in rows}
+
+@event.listens_for(Session, 'before_flush')
+def update_order_stats(session, flush_context, instances):
+    """Moves the orders written by this flush between OrderStat buckets and records
+    the time spent in the status they leave"""
+    now = datetime.datetime.utcnow()
+    counts, durations = {}, {}
+    for order in session.new:
+        if isinstance(order, Order):
+            order.status_changed_at = now
+            if order.active is not False:
+                key = (order.status_id, int(order.helper_id))
+                counts[key] = counts.get(key, 0) + 1
+    changed = [
+        order for order in list(session.dirty) + list(session.deleted)
+        if isinstance(order, Order) and (order in session.deleted or session.is_modified(order))
+    ]
+    previous = locked_orders(session, [order.id for order in changed])
+    for order in changed:
+        if order.id not in previous:
+            # Deleted by another transaction, the flush fails on it
+            continue
+        previous_status_id = previous[order.id].status_id
+        if previous[order.id].active is not False:
+            key = (previous_status_id, previous[order.id].helper_id)
+            counts[key] = counts.get(key, 0) - 1
+        if order in session.deleted:
+            continue
+        if order.active is not False:
+            # helper_id may come straight from the form, as a string
+            key = (order.status_id, int(order.helper_id))
+            counts[key] = counts.get(key, 0) + 1
+        if order.status_id != previous_status_id:
+            if previous[order.id].status_changed_at is not None:
+                durations.setdefault(previous_status_id, []).append((now - previous[order.id].status_changed_at).total_seconds())
+            order.status_changed_at = now
+
+    if any(counts.values()):
+        OrderStat.add(counts, session)
+    if durations:
+        OrderStatusTime.add(durations, session)
+
+@event.listens_for(Session, 'before_flush')
+def bump_table_versions(session, flush_context, instances):
+    """Bumps the version of every table written by this flush, in the same transaction"""
+    changed = set()
+    for instance in list(session.new) + list(session.deleted):
+        changed.add(instance.__tablename__)
+    for instance in session.dirty:
+        if session.is_modified(instance):
+            changed.add(instance.__tablename__)
+    changed &= set(TableVersion.VERSIONED_TABLES)
+
+    TableVersion.bump(changed, session)
@@ -0,0 +1,263 @@
+"""
+Order change events pushed to the clients over Server-Sent Events. Every flush that
+creates, reassigns, changes the status of or deletes an order produces an event;
+the backend carries it to every process once the transaction commits and the
+process' broadcaster hands it to its open streams:
+
+- postgres: NOTIFY in the same transaction, one LISTEN connection per process
+- local: in-process only, for development and a single worker
+"""
+import os
+import json
+import time
+import queue
+import select
+import threading
+import datetime
+from sqlalchemy import event, inspect, create_engine, func, select as sql_select
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+from models import Order, Status
+
+ORDER_EVENTS_CHANNEL = 'order_events'
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+SSE_MAX_STREAM_SECONDS = float(os.environ.get('SSE_MAX_STREAM_SECONDS', 600))
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 100))
+# Per process, not per dyno: each open stream holds one of the WEB_THREADS web threads,
+# the rest must stay free for the API. The dyno takes WEB_CONCURRENCY x SSE_MAX_STREAMS
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 16))
+SSE_RETRY_MILLISECONDS = 3000
+
+STATUS_EVENTS = {
+    Status.PROCESSING_STATUS_ID: 'accepted',
+    Status.REJECTED_STATUS_ID: 'rejected',
+    Status.READY_STATUS_ID: 'ready',
+    Status.APPROVED_STATUS_ID: 'approved',
+    Status.COMPLETED_STATUS_ID: 'completed',
+}
+
+def order_event(event_type, order_id, helper_id, status_id, previous_helper_id=None):
+    return {
+        "type": event_type,
+        "order_id": order_id,
+        "helper_id": helper_id,
+        "previous_helper_id": previous_helper_id,
+        "status_id": status_id,
+        "at": datetime.datetime.utcnow().isoformat() + 'Z',
+    }
+
+def changed_value(order, attribute):
+    """(old value, changed) from the attribute's history, before it's reset"""
+    history = inspect(order).attrs[attribute].history
+    if not history.has_changes():
+        return None, False
+    return (history.deleted[0] if history.deleted else None), True
+
+def flushed_order_events(session):
+    events = []
+    for order in session.new:
+        if isinstance(order, Order):
+            events.append(order_event('created', order.id, int(order.helper_id), order.status_id))
+    for order in session.dirty:
+        if not isinstance(order, Order) or not session.is_modified(order):
+            continue
+        previous_helper_id, reassigned = changed_value(order, 'helper_id')
+        previous_status_id, status_changed = changed_value(order, 'status_id')
+        _, deactivated = changed_value(order, 'active')
+        # helper_id may come straight from the form, as a string
+        helper_id = int(order.helper_id)
+        # update_order sends a rejected order back to pending, to the same helper or another
+        if (reassigned and int(previous_helper_id) != helper_id) or (status_changed and order.status_id == Status.PENDING_STATUS_ID):
+            events.append(order_event('reassigned', order.id, helper_id, order.status_id, int(previous_helper_id) if reassigned else helper_id))
+        elif status_changed and previous_status_id != order.status_id:
+            events.append(order_event(STATUS_EVENTS.get(order.status_id, 'status_changed'), order.id, helper_id, order.status_id))
+        if deactivated and not order.active:
+            events.append(order_event('deleted', order.id, helper_id, order.status_id))
+    return events
+
+class OrderEventBroadcaster():
+    """Fans the events out to the streams open in this process, at most max_streams"""
+
+    def __init__(self, max_streams=SSE_MAX_STREAMS):
+        self.max_streams = max_streams
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._open_streams = 0
+
+    def open_stream(self):
+        """Takes one of the process' stream slots, False when they are all in use"""
+        with self._lock:
+            if self._open_streams >= self.max_streams:
+                return False
+            self._open_streams += 1
+            return True
+
+    def close_stream(self):
+        with self._lock:
+            self._open_streams -= 1
+
+    def subscribe(self, accepts):
+        subscription = Subscription(accepts)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def dispatch(self, order_event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.put(order_event)
+
+class Subscription():
+
+    def __init__(self, accepts):
+        self.accepts = accepts
+        self.events = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, order_event):
+        if self.overflowed or not self.accepts(order_event):
+            return
+        try:
+            self.events.put_nowait(order_event)
+        except queue.Full:
+            # A client this far behind has to reload the list anyway
+            self.overflowed = True
+
+class LocalBackend():
+    name = 'local'
+
+    def __init__(self, app, broadcaster):
+        self.broadcaster = broadcaster
+
+    def publish(self, session, events):
+        session.info.setdefault('order_events', []).extend(events)
+
+    def after_commit(self, session):
+        for order_event in session.info.pop('order_events', []):
+            self.broadcaster.dispatch(order_event)
+
+    def after_rollback(self, session):
+        session.info.pop('order_events', None)
+
+    def start(self):
+        pass
+
+class PostgresBackend():
+    """NOTIFY is transactional: listeners get the events on commit and never for a
+    rolled back transaction"""
+    name = 'postgres'
+
+    def __init__(self, app, broadcaster):
+        self.database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        self.broadcaster = broadcaster
+        self._listener_pid = None
+
+    def publish(self, session, events):
+        connection = session.connection()
+        for order_event in events:
+            connection.execute(sql_select(func.pg_notify(ORDER_EVENTS_CHANNEL, json.dumps(order_event))))
+
+    def after_commit(self, session):
+        pass
+
+    def after_rollback(self, session):
+        pass
+
+    def start(self):
+        # Started lazily in the process that streams, so it survives gunicorn's fork
+        if self._listener_pid == os.getpid():
+            return
+        self._listener_pid = os.getpid()
+        threading.Thread(target=self._listen_forever, daemon=True).start()
+
+    def _listen_forever(self):
+        # Its own connection, outside the pool: it stays in LISTEN for the process' life
+        engine = create_engine(self.database_uri, poolclass=NullPool)
+        while True:
+            try:
+                connection = engine.raw_connection()
+                try:
+                    dbapi_connection = connection.connection
+                    dbapi_connection.autocommit = True
+                    connection.cursor().execute(f'LISTEN {ORDER_EVENTS_CHANNEL}')
+                    while True:
+                        if select.select([dbapi_connection], [], [], SSE_HEARTBEAT_SECONDS) == ([], [], []):
+                            continue
+                        dbapi_connection.poll()
+                        while dbapi_connection.notifies:
+                            notification = dbapi_connection.notifies.pop(0)
+                            self.broadcaster.dispatch(json.loads(notification.payload))
+                finally:
+                    connection.close()
+            except Exception as e:
+                print("Order events listener failed, reconnecting:", e)
+                time.sleep(5)
+
+ORDER_EVENT_BACKENDS = {
+    'local': LocalBackend,
+    'postgres': PostgresBackend,
+}
+
+BROADCASTER = OrderEventBroadcaster()
+backend = None
+
+def queue_order_events(session, events):
+    """For writes that skip the flush, such as bulk UPDATE statements"""
+    if backend is not None and events:
+        backend.publish(session, events)
+
+@event.listens_for(Session, 'after_flush')
+def publish_flushed_order_events(session, flush_context):
+    queue_order_events(session, flushed_order_events(session))
+
+@event.listens_for(Session, 'after_commit')
+def dispatch_committed_order_events(session):
+    if backend is not None:
+        backend.after_commit(session)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_order_events(session):
+    if backend is not None:
+        backend.after_rollback(session)
+
+def format_sse(order_event):
+    return f'data: {json.dumps(order_event)}\n\n'
+
+def stream_order_events(accepts, expires_at=None):
+    """SSE body: the events accepted for this client, a comment as heartbeat so proxies
+    keep the connection open, and the end of the stream when the token expires or
+    after SSE_MAX_STREAM_SECONDS. EventSource reconnects on its own"""
+    deadline = time.time() + SSE_MAX_STREAM_SECONDS
+    if expires_at is not None:
+        deadline = min(deadline, expires_at)
+    backend.start()
+    # Subscribed here, not in the view, so the finally below always unsubscribes
+    subscription = BROADCASTER.subscribe(accepts)
+    try:
+        yield f'retry: {SSE_RETRY_MILLISECONDS}\n\n'
+        while time.time() < deadline:
+            if subscription.overflowed:
+                yield 'event: resync\ndata: {}\n\n'
+                return
+            try:
+                order_event = subscription.events.get(timeout=max(0, min(SSE_HEARTBEAT_SECONDS, deadline - time.time())))
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            yield format_sse(order_event)
+    finally:
+        BROADCASTER.unsubscribe(subscription)
+
+def init_order_events(app):
+    global backend
+    name = app.config.get('ORDER_EVENTS_BACKEND')
+    if not name:
+        name = 'postgres' if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql') else 'local'
+    if name not in ORDER_EVENT_BACKENDS:
+        raise ValueError(f'Unknown order events backend: {name}')
+    backend = ORDER_EVENT_BACKENDS[name](app, BROADCASTER)
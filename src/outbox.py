@@ -0,0 +1,133 @@
+"""
+Transactional email outbox: the API queues emails in the same transaction as the
+change that triggers them and a separate worker (`flask send-emails`) delivers them
+"""
+import os
+import json
+import time
+import datetime
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail
+from models import db, OutboxEmail
+from instrumentation import timed
+from metrics import SENDGRID_REQUEST_DURATION, SENDGRID_FAILURES
+
+MAIL_DEFAULT_SENDER = os.environ.get('MAIL_DEFAULT_SENDER')
+MAIL_MAX_ATTEMPTS = int(os.environ.get('MAIL_MAX_ATTEMPTS', 8))
+MAIL_RETRY_BASE_SECONDS = int(os.environ.get('MAIL_RETRY_BASE_SECONDS', 30))
+MAIL_RETRY_MAX_SECONDS = int(os.environ.get('MAIL_RETRY_MAX_SECONDS', 3600))
+# How long a claimed email stays reserved to its worker, longer than any delivery takes
+MAIL_LEASE_SECONDS = int(os.environ.get('MAIL_LEASE_SECONDS', 300))
+
+class SendGridTransport():
+
+    def __init__(self):
+        self.client = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+
+    def send(self, email):
+        message = Mail(
+            from_email=MAIL_DEFAULT_SENDER,
+            to_emails=email.to_email,
+            subject=email.subject,
+            html_content=email.html_content
+        )
+        started_at = time.perf_counter()
+        try:
+            # SendGridAPIClient raises on 4xx/5xx responses
+            self.client.send(message)
+        except Exception:
+            SENDGRID_FAILURES.inc()
+            raise
+        finally:
+            SENDGRID_REQUEST_DURATION.observe(time.perf_counter() - started_at)
+
+class FileTransport():
+    """Writes every email as a JSON file, for local runs and tests"""
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ.get('MAIL_FILE_DIR', '/tmp/mails')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def send(self, email):
+        path = os.path.join(self.directory, f'{email.id}.json')
+        with open(path, 'w') as mail_file:
+            json.dump({
+                "from_email": MAIL_DEFAULT_SENDER,
+                "to_email": email.to_email,
+                "subject": email.subject,
+                "html_content": email.html_content
+            }, mail_file)
+
+TRANSPORTS = {
+    'sendgrid': SendGridTransport,
+    'file': FileTransport,
+}
+
+def get_transport(name=None):
+    name = name or os.environ.get('MAIL_TRANSPORT', 'sendgrid')
+    if name not in TRANSPORTS:
+        raise ValueError(f'Unknown mail transport: {name}')
+    return TRANSPORTS[name]()
+
+def queue_email(to_email, subject, html_content):
+    if not to_email:
+        print("Mail without recipient, check MAIL_DEFAULT_SENDER: ", subject)
+        return None
+    # No commit here: the email is persisted with the caller's transaction
+    email = OutboxEmail(to_email=to_email, subject=subject, html_content=html_content, status=OutboxEmail.PENDING_STATUS, attempts=0)
+    email.save()
+    return email
+
+def retry_delay(attempts):
+    return datetime.timedelta(seconds=min(MAIL_RETRY_BASE_SECONDS * 2 ** (attempts - 1), MAIL_RETRY_MAX_SECONDS))
+
+def claim_due_emails(batch_size):
+    """Leases a batch of due emails to this worker in a short transaction of its own.
+    The lease moves next_attempt_at forward, so if the worker dies before recording
+    the result the emails are due again once it runs out"""
+    now = datetime.datetime.utcnow()
+    # SKIP LOCKED lets several workers share the outbox on Postgres; SQLite ignores it
+    emails = OutboxEmail.query.filter(
+        OutboxEmail.status == OutboxEmail.PENDING_STATUS,
+        OutboxEmail.next_attempt_at <= now
+    ).order_by(OutboxEmail.next_attempt_at).limit(batch_size).with_for_update(skip_locked=True).all()
+    for email in emails:
+        email.attempts += 1
+        email.next_attempt_at = now + datetime.timedelta(seconds=MAIL_LEASE_SECONDS)
+    db.session.flush()
+    # Detached, the commit doesn't expire them and sending needs no further query
+    for email in emails:
+        db.session.expunge(email)
+    db.session.commit()
+    return emails
+
+@timed('mail')
+def send_email(transport, email):
+    transport.send(email)
+
+def record_delivery(email, error=None):
+    if error is None:
+        values = {"status": OutboxEmail.SENT_STATUS, "sent_at": datetime.datetime.utcnow(), "last_error": None}
+    elif email.attempts >= MAIL_MAX_ATTEMPTS:
+        values = {"status": OutboxEmail.FAILED_STATUS, "last_error": str(error)[:500]}
+    else:
+        values = {"next_attempt_at": datetime.datetime.utcnow() + retry_delay(email.attempts), "last_error": str(error)[:500]}
+    table = OutboxEmail.__table__
+    # Unless the lease ran out and another worker claimed the email again meanwhile
+    db.session.execute(table.update().where(table.c.id == email.id, table.c.attempts == email.attempts).values(**values))
+    db.session.commit()
+
+def deliver_pending_emails(transport, batch_size=50):
+    """Sends one batch of due emails and returns how many were processed. No
+    transaction stays open while the emails are sent"""
+    emails = claim_due_emails(batch_size)
+    for email in emails:
+        try:
+            send_email(transport, email)
+        except Exception as e:
+            print("Mail delivery error: ", str(e))
+            record_delivery(email, e)
+        else:
+            record_delivery(email)
+
+    return len(emails)
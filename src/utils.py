@@ -1,4 +1,13 @@
-from flask import jsonify, url_for
+import base64
+import binascii
+import datetime
+import json
+from flask import url_for
+from jsonprovider import jsonify
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +24,50 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def get_page_limit(args, default=None):
+    # Lists are always paginated, a request without limit gets the default page size
+    limit = args.get('limit', None, type=int)
+    if limit is None:
+        return default or DEFAULT_PAGE_SIZE
+    if limit < 1:
+        raise APIException('limit must be a positive integer', status_code=400)
+    return min(limit, MAX_PAGE_SIZE)
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, *parsers):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(parsers):
+            raise ValueError(cursor)
+        return [parse(value) for parse, value in zip(parsers, values)]
+    except (binascii.Error, TypeError, ValueError):
+        raise APIException('Invalid cursor', status_code=400)
+
+def keyset_page(query, limit, cursor_values):
+    # Fetch one extra row to know whether there is a next page without a COUNT
+    items = query.limit(limit + 1).all()
+    if len(items) <= limit:
+        return items, None
+    items = items[:limit]
+    return items, encode_cursor(cursor_values(items[-1]))
+
+def paginated_response(items_json, next_cursor):
+    response = jsonify(items_json)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return response
+
+def parse_datetime_arg(args, name):
+    value = args.get(name, None)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise APIException(f'{name} must be an ISO 8601 date', status_code=400)
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
@@ -0,0 +1,70 @@
+"""
+Fixtures for the API tests: the app runs against a scratch SQLite file, recreated for
+every test, and is driven through the Flask test client. Run from the repository root:
+
+    pipenv run test
+
+TEST_DATABASE_URL runs them against another database instead, such as an empty
+PostgreSQL database; its tables are dropped and recreated for every test.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATABASE_DIR = tempfile.mkdtemp(prefix='ayudame3d-tests-')
+# main reads its configuration on import
+os.environ['DATABASE_URL'] = os.environ.get('TEST_DATABASE_URL', f'sqlite:///{DATABASE_DIR}/primary.db')
+os.environ.pop('DATABASE_REPLICA_URL', None)
+os.environ['JWT_SECRET_KEY'] = 'tests'
+os.environ['MAIL_DEFAULT_SENDER'] = 'tests@example.org'
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+from werkzeug.security import generate_password_hash
+from main import app as flask_app, USER_ACCESS
+from models import db, User, Order, Role, Status, ROLES, STATUSES
+from instrumentation import StatementCounter
+
+PASSWORD = 'tests'
+# Hashing is slow on purpose, every test user shares the same hash
+PASSWORD_HASH = generate_password_hash(PASSWORD, method='sha256')
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        ROLES.invalidate()
+        STATUSES.invalidate()
+        USER_ACCESS.invalidate()
+        runner = flask_app.test_cli_runner()
+        for command in ('create-roles', 'create-statuses'):
+            result = runner.invoke(args=[command])
+            if result.exception:
+                raise result.exception
+        yield flask_app
+        db.session.remove()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def create_user(email, role_id=Role.HELPER_ROLE_ID, **columns):
+    user = User(email=email, password=PASSWORD_HASH, full_name=email.split('@')[0], phone='600000000', role_id=role_id, is_active=True, **columns)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+def create_orders(helpers, count, **columns):
+    for i in range(count):
+        db.session.add(Order(description=f'Pedido {i}', helper_id=helpers[i % len(helpers)].id, status_id=Status.PENDING_STATUS_ID, **columns))
+    db.session.commit()
+
+def login(client, user):
+    response = client.post('/login', json={'email': user.email, 'password': PASSWORD})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return {'Authorization': 'Bearer ' + response.json['access_token']}
@@ -0,0 +1,24 @@
+from models import db, User, Role
+from main import USER_ACCESS
+from conftest import create_user, login
+
+def test_deactivated_users_tokens_are_revoked(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    helper = create_user('helper@example.org')
+    admin_headers, helper_headers = login(client, admin), login(client, helper)
+    assert client.get('/orders', headers=helper_headers).status_code == 200
+
+    assert client.delete(f'/users/{helper.id}', headers=admin_headers).status_code == 200
+    assert client.get('/orders', headers=helper_headers).status_code == 401
+
+def test_tokens_issued_before_a_role_change_are_revoked(client, monkeypatch):
+    helper = create_user('helper@example.org')
+    headers = login(client, helper)
+    assert client.get('/orders', headers=headers).status_code == 200
+
+    # Promoted by another process: seen once this one checks the user TableVersion
+    monkeypatch.setattr(USER_ACCESS, 'refresh_seconds', 0)
+    User.query.get(helper.id).role_id = Role.ADMIN_ROLE_ID
+    db.session.commit()
+    assert client.get('/orders', headers=headers).status_code == 401
+    assert client.get('/orders', headers=login(client, helper)).status_code == 200
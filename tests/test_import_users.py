@@ -0,0 +1,58 @@
+from models import db, User, Role
+from conftest import create_user, login
+
+def import_users(app, path, *options):
+    result = app.test_cli_runner().invoke(args=['import-users', str(path), '--workers', '1', *options])
+    assert result.exception is None, result.output
+
+def test_reimport_keeps_deactivated_users_deactivated(app, client, tmp_path):
+    path = tmp_path / 'users.csv'
+    path.write_text('email,password,full_name,phone,role_id\nvol@example.org,secret,Voluntario,600000000,3\n')
+    import_users(app, path)
+    user = User.query.filter_by(email='vol@example.org').one()
+    assert user.is_active
+
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    assert client.delete(f'/users/{user.id}', headers=login(client, admin)).status_code == 200
+
+    path.write_text('email,password,full_name,phone,role_id\nvol@example.org,secret,Voluntaria,600000000,3\n')
+    import_users(app, path)
+    user = User.query.filter_by(email='vol@example.org').one()
+    assert user.full_name == 'Voluntaria'
+    assert not user.is_active
+
+    import_users(app, path, '--reactivate')
+    db.session.expire_all()
+    assert User.query.filter_by(email='vol@example.org').one().is_active
+
+def test_invalid_rows_are_skipped_and_reported(app, tmp_path):
+    path = tmp_path / 'users.csv'
+    path.write_text(
+        'email,password,full_name,phone,role_id\n'
+        'ok@example.org,secret,Voluntario,600000000,3\n'
+        ',secret,Sin email,600000000,3\n'
+        'noname@example.org,secret,,600000000,3\n'
+        'norole@example.org,secret,Voluntario,600000000,99\n'
+        'badrole@example.org,secret,Voluntario,600000000,helper\n'
+        'default@example.org,,Voluntario,,\n'
+    )
+    result = app.test_cli_runner().invoke(args=['import-users', str(path), '--workers', '1'])
+    assert result.exception is None, result.output
+
+    assert 'Line 3 skipped: missing email' in result.output
+    assert 'Line 4 skipped: missing full_name' in result.output
+    assert 'Line 5 skipped: role_id 99 does not exist' in result.output
+    assert "Line 6 skipped: role_id 'helper' is not a number" in result.output
+    assert '2 users imported, 4 rows skipped' in result.output
+    assert {user.email: user.role_id for user in User.query} == {'ok@example.org': 3, 'default@example.org': Role.HELPER_ROLE_ID}
+
+def test_ndjson_lines_are_numbered(app, tmp_path):
+    path = tmp_path / 'users.ndjson'
+    path.write_text('{"email": "ok@example.org", "full_name": "Voluntario"}\n\nnot json\n["list"]\n{"email": "x@example.org", "full_name": "X", "password": 1}\n')
+    result = app.test_cli_runner().invoke(args=['import-users', str(path), '--workers', '1'])
+    assert result.exception is None, result.output
+
+    assert 'Line 3 skipped: not a JSON object' in result.output
+    assert 'Line 4 skipped: not a JSON object' in result.output
+    assert 'Line 5 skipped: password must be text' in result.output
+    assert [user.email for user in User.query] == ['ok@example.org']
@@ -0,0 +1,27 @@
+from models import db, Role, LookupTableCache
+
+def test_reloads_when_another_process_changes_the_table(app):
+    roles = LookupTableCache(Role, refresh_seconds=0)
+    assert roles.get(Role.HELPER_ROLE_ID)["name"] == 'Helper'
+
+    # A statement outside the ORM doesn't bump the table version: the copy is kept
+    db.session.execute(Role.__table__.update().where(Role.__table__.c.id == Role.HELPER_ROLE_ID).values(name='Voluntario'))
+    db.session.commit()
+    assert roles.get(Role.HELPER_ROLE_ID)["name"] == 'Helper'
+
+    # A seed command in another process writes through the ORM, which bumps it
+    role = Role.query.get(Role.MANAGER_ROLE_ID)
+    role.name = 'Coordinador'
+    role.save()
+    db.session.commit()
+    assert roles.get(Role.HELPER_ROLE_ID)["name"] == 'Voluntario'
+    assert roles.get(Role.MANAGER_ROLE_ID)["name"] == 'Coordinador'
+
+def test_checks_the_version_at_most_every_refresh_seconds(app):
+    roles = LookupTableCache(Role, refresh_seconds=3600)
+    roles.all()
+    role = Role.query.get(Role.MANAGER_ROLE_ID)
+    role.name = 'Coordinador'
+    role.save()
+    db.session.commit()
+    assert roles.get(Role.MANAGER_ROLE_ID)["name"] == 'Manager'
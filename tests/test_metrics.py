@@ -0,0 +1,58 @@
+import os
+import sys
+import runpy
+import subprocess
+
+import pytest
+
+import metrics
+from models import db, Role
+from conftest import ROOT, create_user, login
+
+@pytest.fixture
+def metrics_env(monkeypatch):
+    for name in ('METRICS_TOKEN', 'METRICS_PUBLIC', 'PROMETHEUS_MULTIPROC_DIR'):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+def test_metrics_need_the_token_by_default(client, metrics_env):
+    assert client.get('/metrics').status_code == 401
+    metrics_env.setenv('METRICS_TOKEN', 'secret')
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 401
+
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    client.get('/orders', headers=login(client, admin))
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert 'http_requests_total{method="GET",route="/orders",status="200"}' in response.get_data(as_text=True)
+
+    metrics_env.delenv('METRICS_TOKEN')
+    metrics_env.setenv('METRICS_PUBLIC', 'true')
+    assert client.get('/metrics').status_code == 200
+
+def test_pool_metrics(client, metrics_env):
+    if db.engine.dialect.name == 'sqlite':
+        pytest.skip('SQLite keeps the default pool')
+    metrics_env.setenv('METRICS_PUBLIC', 'true')
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    client.get('/orders', headers=login(client, admin))
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'db_pool_checked_out{pool="primary"}' in body
+    assert 'db_pool_checkout_seconds_count{pool="primary"}' in body
+
+def test_metrics_add_up_across_processes(tmp_path, monkeypatch):
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path), PYTHONPATH=os.path.join(ROOT, 'src'))
+    script = 'import os, metrics; metrics.SENDGRID_FAILURES.inc(); metrics.HTTP_REQUESTS_IN_FLIGHT.inc(); print(os.getpid())'
+    pids = [int(subprocess.check_output([sys.executable, '-c', script], env=env)) for _ in range(2)]
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+
+    body = metrics.collect().decode()
+    assert 'sendgrid_failures_total 2.0' in body
+    assert 'http_requests_in_flight 2.0' in body
+
+    # gunicorn's hook for a worker that exited: its gauges go, its counters stay
+    hooks = runpy.run_path(os.path.join(ROOT, 'gunicorn.conf.py'))
+    hooks['child_exit'](None, type('Worker', (), {'pid': pids[0]}))
+    body = metrics.collect().decode()
+    assert 'sendgrid_failures_total 2.0' in body
+    assert 'http_requests_in_flight 1.0' in body
@@ -0,0 +1,45 @@
+import pytest
+from sqlalchemy.orm import Session
+
+from models import db, OrderChange, Role
+from conftest import create_user, create_orders, login
+
+def changes_since(client, headers, cursor):
+    response = client.get('/orders/changes', headers=headers, query_string={'since': cursor})
+    assert response.status_code == 200
+    return [change['id'] for change in response.json['changes']], response.json['cursor']
+
+@pytest.fixture
+def admin_headers(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    create_orders([admin], 3)
+    return login(client, admin)
+
+def test_changes_after_the_cursor(client, admin_headers):
+    cursor = client.get('/orders/changes', headers=admin_headers).json['cursor']
+    assert changes_since(client, admin_headers, cursor) == ([], cursor)
+
+    assert client.put('/orders/2', headers=admin_headers, data={'description': 'Written', 'long_description': ''}).status_code == 200
+    assert client.put('/orders/2', headers=admin_headers, data={'description': 'Again', 'long_description': ''}).status_code == 200
+    response = client.get('/orders/changes', headers=admin_headers, query_string={'since': cursor})
+    assert [change['order']['description'] for change in response.json['changes']] == ['Again']
+
+    assert changes_since(client, admin_headers, response.json['cursor'])[0] == []
+
+def test_change_committed_after_a_later_one_is_not_skipped(client, admin_headers):
+    if db.engine.dialect.name != 'postgresql':
+        pytest.skip('SQLite runs one writing transaction at a time')
+    cursor = client.get('/orders/changes', headers=admin_headers).json['cursor']
+
+    # Takes the lower id but commits last
+    other = Session(db.engine)
+    OrderChange.record([(1, 1)], other)
+    assert client.put('/orders/2', headers=admin_headers, data={'description': 'Written', 'long_description': ''}).status_code == 200
+
+    seen, cursor = changes_since(client, admin_headers, cursor)
+    # Held back while the older transaction runs
+    assert seen == []
+    other.commit()
+    other.close()
+    later, cursor = changes_since(client, admin_headers, cursor)
+    assert sorted(seen + later) == [1, 2]
@@ -0,0 +1,20 @@
+from orderevents import BROADCASTER
+from models import Role
+from conftest import create_user, login
+
+def test_streams_past_the_limit_get_503(client, monkeypatch):
+    monkeypatch.setattr(BROADCASTER, 'max_streams', 1)
+    headers = login(client, create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID))
+
+    stream = client.get('/orders/events', headers=headers, buffered=False)
+    assert stream.status_code == 200
+    busy = client.get('/orders/events', headers=headers, buffered=False)
+    assert busy.status_code == 503
+    assert busy.headers['Retry-After']
+
+    # Closing the response frees the slot, even if the stream was never read
+    stream.close()
+    again = client.get('/orders/events', headers=headers, buffered=False)
+    assert again.status_code == 200
+    assert next(again.response).startswith(b'retry:')
+    again.close()
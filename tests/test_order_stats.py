@@ -0,0 +1,98 @@
+import time
+import threading
+
+import pytest
+from sqlalchemy.orm import Session
+
+import main
+from models import db, Order, OrderStat, OrderChange, OutboxEmail, Role, Status, locked_orders
+from conftest import create_user, create_orders, login
+
+def assert_stats_match_orders():
+    actual = {
+        (status_id, helper_id): orders
+        for status_id, helper_id, orders in db.session.query(Order.status_id, Order.helper_id, db.func.count()).filter(Order.active == True).group_by(Order.status_id, Order.helper_id)
+    }
+    stored = {(stat.status_id, stat.helper_id): stat.orders for stat in OrderStat.query if stat.orders}
+    assert stored == actual
+
+def require_postgresql():
+    if db.engine.dialect.name != 'postgresql':
+        pytest.skip('SQLite runs one writing transaction at a time')
+
+def in_thread(function):
+    errors = []
+    def run():
+        try:
+            with main.app.app_context():
+                function()
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    # Long enough for it to block on the lock the test holds
+    time.sleep(0.3)
+    return thread, errors
+
+def test_bulk_status_only_reports_orders_that_changed(client, monkeypatch):
+    events = []
+    monkeypatch.setattr(main, 'queue_order_events', lambda session, queued: events.extend(queued))
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    create_orders([admin], 3)
+    Order.query.get(1).status_id = Status.READY_STATUS_ID
+    db.session.commit()
+    changes, emails = OrderChange.query.count(), OutboxEmail.query.count()
+
+    response = client.post('/orders/bulk/status', headers=login(client, admin), json={'order_ids': [1, 2, 3], 'status_id': Status.READY_STATUS_ID})
+    assert response.status_code == 200
+    assert [result['status'] for result in response.json['results']] == ['updated'] * 3
+    assert [event['order_id'] for event in events] == [2, 3]
+    assert OrderChange.query.count() == changes + 2
+    assert OutboxEmail.query.count() == emails + 1
+    assert OutboxEmail.query.order_by(OutboxEmail.id.desc()).first().subject.startswith('2 pedidos')
+    assert_stats_match_orders()
+
+def test_concurrent_first_counts_of_a_bucket_add_up(app):
+    require_postgresql()
+    first, second = Session(bind=db.engine), Session(bind=db.engine)
+    OrderStat.add({(Status.PENDING_STATUS_ID, 99): 1}, first)
+
+    def add_and_commit():
+        OrderStat.add({(Status.PENDING_STATUS_ID, 99): 1}, second)
+        second.commit()
+    thread, errors = in_thread(add_and_commit)
+    first.commit()
+    thread.join()
+    first.close()
+    second.close()
+
+    assert errors == []
+    assert OrderStat.query.get((Status.PENDING_STATUS_ID, 99)).orders == 2
+
+def test_order_updates_lock_like_the_bulk_endpoint(app):
+    require_postgresql()
+    helper = create_user('helper@example.org')
+    create_orders([helper], 2)
+    bulk = Session(bind=db.engine)
+    # The bulk endpoint holds the orders...
+    locked_orders(bulk, [1, 2])
+
+    def update_one_order():
+        session = Session(bind=db.engine)
+        order = session.query(Order).get(1)
+        order.status_id = Status.PROCESSING_STATUS_ID
+        session.commit()
+        session.close()
+    thread, errors = in_thread(update_one_order)
+    # ...and then moves the stats, while the other transaction waits for the order
+    OrderStat.add({(Status.PENDING_STATUS_ID, helper.id): -1, (Status.READY_STATUS_ID, helper.id): 1}, bulk)
+    bulk.execute(Order.__table__.update().where(Order.__table__.c.id == 1).values(status_id=Status.READY_STATUS_ID))
+    bulk.commit()
+    thread.join()
+    bulk.close()
+
+    assert errors == []
+    db.session.remove()
+    assert Order.query.get(1).status_id == Status.PROCESSING_STATUS_ID
+    # The single order update counted it out of Ready, where the bulk endpoint left it
+    assert_stats_match_orders()
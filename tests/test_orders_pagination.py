@@ -0,0 +1,68 @@
+import datetime
+
+from models import db, Order, ArchivedOrder, Role, Status
+import utils
+from utils import NEXT_CURSOR_HEADER
+from conftest import create_user, login
+
+def create_dated_orders(helper, count):
+    now = datetime.datetime(2021, 3, 1, 12, 0, 0)
+    orders = [Order(description=f'Pedido {i}', helper_id=helper.id, status_id=Status.PENDING_STATUS_ID, created_at=now - datetime.timedelta(hours=i)) for i in range(count)]
+    db.session.add_all(orders)
+    db.session.commit()
+    return [order.id for order in orders]
+
+def get_page(client, headers, cursor=None):
+    path = '/orders?limit=3' + (f'&cursor={cursor}' if cursor else '')
+    response = client.get(path, headers=headers)
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return [order['id'] for order in response.json], response.headers.get(NEXT_CURSOR_HEADER)
+
+def test_pages_cover_every_order_once(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    headers = login(client, admin)
+    order_ids = create_dated_orders(admin, 8)
+
+    seen, cursor = [], None
+    while True:
+        page, cursor = get_page(client, headers, cursor)
+        seen.extend(page)
+        if cursor is None:
+            break
+    assert seen == order_ids
+
+def test_cursor_survives_its_order_being_archived(app, client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    headers = login(client, admin)
+    order_ids = create_dated_orders(admin, 8)
+
+    first_page, cursor = get_page(client, headers)
+    # The last order of the page is completed long ago and archived before the next page
+    order = Order.query.get(first_page[-1])
+    order.status_id = Status.COMPLETED_STATUS_ID
+    db.session.commit()
+    order.status_changed_at = datetime.datetime(2000, 1, 1)
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['archive-orders', '--older-than', '1'])
+    assert result.exception is None, result.output
+    assert ArchivedOrder.query.get(first_page[-1]) is not None
+
+    second_page, _ = get_page(client, headers, cursor)
+    assert second_page == order_ids[3:6]
+
+def test_invalid_cursor_is_rejected(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    response = client.get('/orders?limit=3&cursor=not-a-cursor', headers=login(client, admin))
+    assert response.status_code == 400
+
+def test_listing_without_limit_is_paginated(client, monkeypatch):
+    monkeypatch.setattr(utils, 'DEFAULT_PAGE_SIZE', 3)
+    monkeypatch.setattr(utils, 'MAX_PAGE_SIZE', 5)
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    headers = login(client, admin)
+    order_ids = create_dated_orders(admin, 8)
+
+    response = client.get('/orders', headers=headers)
+    assert [order['id'] for order in response.json] == order_ids[:3]
+    assert response.headers.get(NEXT_CURSOR_HEADER) is not None
+    assert len(client.get('/orders?limit=100', headers=headers).json) == 5
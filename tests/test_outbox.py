@@ -0,0 +1,63 @@
+import datetime
+
+from models import db, OutboxEmail
+from outbox import queue_email, claim_due_emails, deliver_pending_emails, record_delivery
+
+class RecordingTransport():
+
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    def send(self, email):
+        # The claim is committed before sending, no row lock is held meanwhile
+        assert not db.session().in_transaction()
+        self.sent.append(email.id)
+        if self.error:
+            raise self.error
+
+def queue(count):
+    emails = [queue_email(f'helper{i}@example.org', f'Asunto {i}', '<p>Hola</p>') for i in range(count)]
+    db.session.commit()
+    return [email.id for email in emails]
+
+def test_delivery_marks_emails_sent(app):
+    email_ids = queue(2)
+    transport = RecordingTransport()
+
+    assert deliver_pending_emails(transport) == 2
+    assert sorted(transport.sent) == email_ids
+    assert {email.status for email in OutboxEmail.query} == {OutboxEmail.SENT_STATUS}
+    assert deliver_pending_emails(transport) == 0
+
+def test_failed_delivery_is_retried_later(app):
+    email_id, = queue(1)
+
+    assert deliver_pending_emails(RecordingTransport(error=RuntimeError('SMTP down'))) == 1
+    email = OutboxEmail.query.get(email_id)
+    assert (email.status, email.attempts, email.last_error) == (OutboxEmail.PENDING_STATUS, 1, 'SMTP down')
+    assert email.next_attempt_at > datetime.datetime.utcnow()
+    assert deliver_pending_emails(RecordingTransport()) == 0
+
+def test_claimed_emails_are_left_to_their_worker(app):
+    queue(1)
+    # Another worker claimed the email and is still sending it
+    email, = claim_due_emails(10)
+
+    other = RecordingTransport()
+    assert deliver_pending_emails(other) == 0
+    record_delivery(email)
+    assert OutboxEmail.query.get(email.id).status == OutboxEmail.SENT_STATUS
+
+def test_expired_lease_is_claimed_again(app):
+    queue(1)
+    stale, = claim_due_emails(10)
+    # The first worker died: its lease runs out
+    OutboxEmail.query.update({OutboxEmail.next_attempt_at: datetime.datetime.utcnow() - datetime.timedelta(seconds=1)})
+    db.session.commit()
+
+    assert deliver_pending_emails(RecordingTransport()) == 1
+    # The late result of the first worker doesn't overwrite the second one's
+    record_delivery(stale, RuntimeError('late'))
+    email = OutboxEmail.query.get(stale.id)
+    assert (email.status, email.attempts, email.last_error) == (OutboxEmail.SENT_STATUS, 2, None)
@@ -0,0 +1,35 @@
+"""
+The listings load every relationship they serialize in the same query, so the number of
+SQL statements per request doesn't depend on the number of rows
+"""
+import pytest
+
+from models import db, Role
+from conftest import StatementCounter, create_user, create_orders, login
+
+ROWS = 5
+
+def seed(rows):
+    helpers = [create_user(f'helper-{rows}-{i}@example.org') for i in range(rows)]
+    create_orders(helpers, rows)
+
+def count_statements(client, headers, path):
+    # Warm up the lookup and inactive users caches, which load once per process
+    assert client.get(path, headers=headers).status_code == 200
+    with StatementCounter(db.engine) as counter:
+        response = client.get(path, headers=headers)
+    assert response.status_code == 200
+    return counter.count, len(response.json)
+
+@pytest.mark.parametrize('path', ['/orders', '/users', '/helpers'])
+def test_statement_count_does_not_grow_with_rows(client, path):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    headers = login(client, admin)
+
+    seed(ROWS)
+    statements, items = count_statements(client, headers, path)
+    seed(ROWS * 9)
+    more_statements, more_items = count_statements(client, headers, path)
+
+    assert more_items > items
+    assert more_statements == statements
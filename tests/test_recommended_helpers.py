@@ -0,0 +1,23 @@
+import datetime
+
+import main
+from models import db, Order, Role, Status
+from conftest import create_user, login
+
+def test_etag_changes_when_orders_leave_the_window(client, monkeypatch):
+    headers = login(client, create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID))
+    helper = create_user('helper@example.org')
+    ten_days_ago = datetime.datetime.utcnow() - datetime.timedelta(days=10)
+    db.session.add(Order(description='Pedido', helper_id=helper.id, status_id=Status.REJECTED_STATUS_ID, created_at=ten_days_ago))
+    db.session.commit()
+
+    response = client.get('/helpers/recommended', headers=headers)
+    assert response.json[0]["recent_rejections"] == 1
+    etag = response.headers['ETag']
+    assert client.get('/helpers/recommended', headers={**headers, 'If-None-Match': etag}).status_code == 304
+
+    # Days later, with no write in between, the order is out of the window
+    monkeypatch.setattr(main, 'RECOMMENDATION_DAYS', 5)
+    response = client.get('/helpers/recommended', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.json[0]["recent_rejections"] == 0
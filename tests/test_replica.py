@@ -0,0 +1,100 @@
+import os
+import shutil
+
+import pytest
+from flask import g
+from flask_sqlalchemy import get_state
+
+from instrumentation import StatementCounter
+from models import db, Order, Role, REPLICA_BIND
+from conftest import DATABASE_DIR, create_user, create_orders, login
+
+@pytest.fixture
+def replica(app, monkeypatch):
+    """A second SQLite file as the replica, starting as a copy of the primary"""
+    if db.engine.dialect.name != 'sqlite':
+        pytest.skip('the replica is a copy of the SQLite primary file')
+    path = os.path.join(DATABASE_DIR, 'replica.db')
+    monkeypatch.setitem(app.config, 'SQLALCHEMY_BINDS', {REPLICA_BIND: f'sqlite:///{path}'})
+    monkeypatch.setitem(app.config, 'REPLICA_READ_YOUR_WRITES_SECONDS', 0)
+    # The test client talks plain http
+    monkeypatch.setitem(app.config, 'SESSION_COOKIE_SECURE', False)
+    # The test client reuses the test's app context, and so its g, for every request
+    def reset_routing():
+        g.pop('use_replica', None)
+    monkeypatch.setitem(app.before_request_funcs, None, [reset_routing] + app.before_request_funcs.get(None, []))
+
+    def sync():
+        db.session.remove()
+        shutil.copy(os.path.join(DATABASE_DIR, 'primary.db'), path)
+    yield sync
+    db.session.remove()
+    connector = get_state(app).connectors.pop(REPLICA_BIND, None)
+    if connector is not None:
+        connector.get_engine().dispose()
+
+def replica_description(order_id):
+    engine = db.get_engine(bind=REPLICA_BIND)
+    return engine.execute(Order.__table__.select().where(Order.__table__.c.id == order_id)).first().description
+
+def listed_description(client, headers, order_id):
+    response = client.get('/orders', headers=headers)
+    assert response.status_code == 200
+    return next(order['description'] for order in response.json if order['id'] == order_id)
+
+@pytest.fixture
+def admin_headers(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    create_orders([admin], 3)
+    return login(client, admin)
+
+def test_marked_views_read_the_replica(client, replica, admin_headers):
+    replica()
+    # Changed on the primary only, as if the replica lagged behind
+    db.session.execute(Order.__table__.update().where(Order.__table__.c.id == 1).values(description='Primary'))
+    db.session.commit()
+
+    assert listed_description(client, admin_headers, 1) == 'Pedido 0'
+    # GET /orders/<id> isn't marked
+    assert client.get('/orders/1', headers=admin_headers).json['description'] == 'Primary'
+
+def test_writes_go_to_the_primary(client, replica, admin_headers):
+    replica()
+    response = client.put('/orders/2', headers=admin_headers, data={'description': 'Written', 'long_description': ''})
+    assert response.status_code == 200
+
+    assert Order.query.get(2).description == 'Written'
+    assert replica_description(2) == 'Pedido 1'
+
+def test_users_read_their_own_writes_from_the_primary(app, client, replica, admin_headers):
+    app.config['REPLICA_READ_YOUR_WRITES_SECONDS'] = 60
+    replica()
+    assert client.put('/orders/2', headers=admin_headers, data={'description': 'Written', 'long_description': ''}).status_code == 200
+
+    assert listed_description(client, admin_headers, 2) == 'Written'
+
+def test_replica_reads_need_no_primary_query(app, client, replica, admin_headers):
+    app.config['REPLICA_READ_YOUR_WRITES_SECONDS'] = 60
+    replica()
+    # Loads the users' access cache
+    listed_description(client, admin_headers, 1)
+    with StatementCounter(db.engine) as counter:
+        assert listed_description(client, admin_headers, 1) == 'Pedido 0'
+    assert counter.count == 0
+
+def test_own_writes_cookie_is_per_user(app, client, replica, admin_headers):
+    app.config['REPLICA_READ_YOUR_WRITES_SECONDS'] = 60
+    other_headers = login(client, create_user('other@example.org', role_id=Role.ADMIN_ROLE_ID))
+    replica()
+    assert client.put('/orders/2', headers=admin_headers, data={'description': 'Written', 'long_description': ''}).status_code == 200
+
+    # Same browser, so same cookie, but someone else's token
+    assert listed_description(client, other_headers, 2) == 'Pedido 1'
+
+def test_get_bind_through_the_scoped_session(app, replica):
+    replica_engine = db.get_engine(bind=REPLICA_BIND)
+    assert db.session.get_bind() is db.engine
+    assert db.session.get_bind(bind=replica_engine) is replica_engine
+    with app.test_request_context():
+        g.use_replica = True
+        assert db.session.get_bind() is replica_engine
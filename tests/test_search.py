@@ -0,0 +1,59 @@
+from models import db, Order, Role, Status
+from conftest import create_user, login
+
+def create_order(helper, description, long_description=None, status_id=Status.PENDING_STATUS_ID):
+    order = Order(description=description, long_description=long_description, helper_id=helper.id, status_id=status_id)
+    db.session.add(order)
+    db.session.commit()
+    return order.id
+
+def search(client, headers, q):
+    response = client.get('/orders/search', headers=headers, query_string={'q': q})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return [order['id'] for order in response.json]
+
+def test_matches_prefixes_without_accents_ranked_by_field(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    headers = login(client, admin)
+    in_long_description = create_order(admin, 'Adaptador', 'Para una prótesis de mano')
+    in_description = create_order(admin, 'Prótesis de mano')
+    create_order(admin, 'Salvaorejas')
+
+    assert search(client, headers, 'protesis') == [in_description, in_long_description]
+    assert search(client, headers, 'prot man') == [in_description, in_long_description]
+    assert search(client, headers, 'protesis salvaorejas') == []
+
+def test_quotes_and_operators_are_plain_text(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    headers = login(client, admin)
+    order_id = create_order(admin, 'Soporte "tablet"')
+
+    assert search(client, headers, '"tablet') == [order_id]
+    assert search(client, headers, 'soporte OR NOT -tablet*') == []
+
+def test_helpers_only_find_their_orders(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    helper = create_user('helper@example.org')
+    own = create_order(helper, 'Pantalla protectora')
+    create_order(admin, 'Pantalla protectora')
+    create_order(helper, 'Pantalla protectora', status_id=Status.REJECTED_STATUS_ID)
+
+    assert search(client, login(client, helper), 'pantalla') == [own]
+
+def test_q_without_words_is_rejected(client):
+    headers = login(client, create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID))
+    assert client.get('/orders/search?q=%22%2A', headers=headers).status_code == 400
+
+def test_unchanged_results_answer_not_modified(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    headers = login(client, admin)
+    order_id = create_order(admin, 'Pantalla protectora')
+    etag = client.get('/orders/search', headers=headers, query_string={'q': 'pantalla'}).headers['ETag']
+
+    response = client.get('/orders/search', headers={**headers, 'If-None-Match': etag}, query_string={'q': 'pantalla'})
+    assert response.status_code == 304
+
+    assert client.put(f'/orders/{order_id}', headers=headers, data={'description': 'Visera', 'long_description': ''}).status_code == 200
+    response = client.get('/orders/search', headers={**headers, 'If-None-Match': etag}, query_string={'q': 'pantalla'})
+    assert response.status_code == 200
+    assert response.json == []
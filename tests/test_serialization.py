@@ -0,0 +1,39 @@
+import datetime
+
+from models import db, Document, Order, ArchivedOrder, Role, Status
+from conftest import create_user, create_orders, login
+
+def test_responses_only_carry_the_listed_columns(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID, reset_password_token='token')
+    create_orders([admin], 1)
+    db.session.add(Document(name='video.mp4', url='https://example.org/video.mp4', order_id=1, user_id=admin.id, sha256='0' * 64, size=10))
+    db.session.commit()
+
+    response = client.post('/login', json={'email': admin.email, 'password': 'tests'})
+    assert set(response.json['user']) == {'id', 'email', 'full_name', 'phone', 'role_id', 'role'}
+
+    order = client.get('/orders/1', headers=login(client, admin)).json
+    assert set(order) == {'id', 'helper_id', 'status_id', 'description', 'long_description', 'created_at', 'helper', 'status', 'documents'}
+    assert set(order['documents'][0]) == {'id', 'name', 'url', 'user_id'}
+    assert order['status'] == {'id': 1, 'name': 'Pending'}
+
+def test_dates_use_the_http_format(app):
+    create_orders([create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)], 1)
+    assert Order.query.get(1).serialize()['created_at'].endswith(' GMT')
+
+def test_archived_orders_carry_the_archive_date(app, client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    headers = login(client, admin)
+    create_orders([admin], 1)
+    order = Order.query.get(1)
+    order.status_id = Status.COMPLETED_STATUS_ID
+    db.session.commit()
+    order.status_changed_at = datetime.datetime(2000, 1, 1)
+    db.session.commit()
+    result = app.test_cli_runner().invoke(args=['archive-orders', '--older-than', '1'])
+    assert result.exception is None, result.output
+
+    order, = client.get('/orders/archive', headers=headers).json
+    assert set(order) == {'id', 'helper_id', 'status_id', 'description', 'long_description', 'created_at', 'archived_at', 'helper', 'status', 'archived'}
+    assert order['archived_at'].endswith(' GMT')
+    assert ArchivedOrder.query.get(order['id']).archived_at is not None
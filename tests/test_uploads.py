@@ -0,0 +1,43 @@
+import pytest
+
+import main
+from models import Document, Role
+from conftest import create_user, create_orders, login
+
+BUCKET = 'tests-bucket'
+
+@pytest.fixture
+def uploads(monkeypatch):
+    monkeypatch.setenv('AWS_S3_BUCKET_NAME', BUCKET)
+    # Every key the tests finalize was uploaded
+    monkeypatch.setattr(main, 'get_uploaded_object', lambda bucket_name, key: {'ContentLength': 1024})
+
+@pytest.fixture
+def admin_headers(client):
+    admin = create_user('admin@example.org', role_id=Role.ADMIN_ROLE_ID)
+    create_orders([admin], 1)
+    return login(client, admin)
+
+def finalize(client, headers, key, filename='video.mp4'):
+    return client.post('/orders/1/uploads/finalize', headers=headers, json={'key': key, 'filename': filename})
+
+def test_finalize_creates_one_document_per_key(client, uploads, admin_headers):
+    assert finalize(client, admin_headers, 'orders/1/abc/video.mp4').status_code == 201
+    assert finalize(client, admin_headers, 'orders/1/abc/video.mp4').status_code == 409
+    assert finalize(client, admin_headers, 'orders/1/def/video.mp4').status_code == 201
+    assert Document.query.count() == 2
+
+def test_finalize_rejects_values_longer_than_the_columns(client, uploads, admin_headers):
+    assert finalize(client, admin_headers, 'orders/1/abc/video.mp4', filename='x' * 251).status_code == 400
+    assert finalize(client, admin_headers, 'orders/1/abc/' + 'x' * 255).status_code == 400
+    assert finalize(client, admin_headers, ['orders/1/abc/video.mp4']).status_code == 400
+    assert Document.query.count() == 0
+
+def test_upload_rejects_a_filename_longer_than_the_columns(client, uploads, admin_headers):
+    response = client.post('/orders/1/uploads', headers=admin_headers, json={'filename': 'x' * 251 + '.mp4', 'content_type': 'video/mp4', 'size': 1024})
+    assert response.status_code == 400
+
+def test_upload_rejects_fields_of_the_wrong_type(client, uploads, admin_headers):
+    for fields in ({'content_type': ['video/mp4']}, {'content_type': 4}, {'size': '1024'}, {'size': True}):
+        body = dict({'filename': 'video.mp4', 'content_type': 'video/mp4', 'size': 1024}, **fields)
+        assert client.post('/orders/1/uploads', headers=admin_headers, json=body).status_code == 400